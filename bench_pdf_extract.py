@@ -0,0 +1,112 @@
+"""Compare peak RSS and per-page CPU of the old and new PDF text extraction.
+
+baseline is the original per-page loop with gc.collect(), batched is the
+version that collected every image of the document before OCRing them at
+once, new is pdf_extract.
+
+    python bench_pdf_extract.py report.pdf [--ocr] [--planner]
+
+Each mode runs in its own process so peak RSS is not shared. Without --ocr
+images are extracted but not OCRed, which measures PyMuPDF and memory
+handling only. With --ocr and OCR_CLOUD_BACKEND=stub the whole OCR path
+runs offline. The image planner is off unless --planner is given, so both
+modes extract the same images.
+"""
+import argparse
+import gc
+import io
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import fitz #Import PyMuPDF
+
+def no_ocr(images):
+    return ["" for _ in images]
+
+def extract_old(data, ocr):
+    # The extraction as it was: copy into BytesIO, copy again, += per page, collect per page
+    pdf_stream = io.BytesIO(data)
+    pdf_reader = fitz.open("pdf", pdf_stream.getvalue())
+    combined_text = ""
+    for page_num in range(len(pdf_reader)):
+        page = pdf_reader[page_num]
+        images = [pdf_reader.extract_image(img[0])["image"] for img in page.get_images(full=True)]
+        combined_text += page.get_text("text") + "\n" + "\n".join(ocr(images)) + "\n"
+        del page, images
+        gc.collect()
+    pages = len(pdf_reader)
+    pdf_reader.close()
+    return combined_text, pages
+
+def extract_batched(data, ocr):
+    # Collect page text and every image first, OCR them all at once, then join with +=
+    pdf_stream = io.BytesIO(data)
+    pdf_reader = fitz.open("pdf", pdf_stream.getvalue())
+    page_texts = []
+    page_images = []
+    for page_num in range(len(pdf_reader)):
+        page = pdf_reader[page_num]
+        page_texts.append(page.get_text("text"))
+        for img in page.get_images(full=True):
+            page_images.append((page_num, pdf_reader.extract_image(img[0])["image"]))
+    image_texts = [[] for _ in page_texts]
+    for (page_num, _), text in zip(page_images, ocr([image_bytes for _, image_bytes in page_images])):
+        image_texts[page_num].append(text)
+    del page_images
+    combined_text = ""
+    for page_text, texts in zip(page_texts, image_texts):
+        combined_text += page_text + "\n" + "\n".join(texts) + "\n"
+    pages = len(pdf_reader)
+    pdf_reader.close()
+    del pdf_stream
+    gc.collect()
+    return combined_text, pages
+
+def extract_new(data, ocr):
+    from pdf_extract import open_pdf, extract_text
+    pdf_reader = open_pdf(data)
+    combined_text = extract_text(pdf_reader, ocr=ocr)
+    pages = len(pdf_reader)
+    pdf_reader.close()
+    return combined_text, pages
+
+MODES = {'baseline': extract_old, 'batched': extract_batched, 'new': extract_new}
+
+def run(mode, path, use_ocr):
+    # Same imports in every mode, so their memory doesn't count against one of them
+    import pdf_extract  # noqa: F401
+    if use_ocr:
+        import image_preprocess
+        image_preprocess.start()
+        from ocr import ocr_images as ocr
+    else:
+        ocr = no_ocr
+    with open(path, 'rb') as f:
+        data = f.read()
+    start = time.process_time()
+    text, pages = MODES[mode](data, ocr)
+    cpu = time.process_time() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode}: {pages} pages, {len(text)} chars, peak RSS {peak_mb:.1f} MB, CPU {cpu * 1000 / max(pages, 1):.1f} ms/page")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pdf")
+    parser.add_argument("--ocr", action="store_true", help="send images to the configured OCR")
+    parser.add_argument("--planner", action="store_true", help="let the new mode skip images it doesn't need")
+    parser.add_argument("--mode", choices=list(MODES), help="run one mode in this process")
+    args = parser.parse_args()
+    if not args.planner:
+        os.environ["PDF_OCR_PLANNER"] = "False"
+    if args.mode:
+        run(args.mode, args.pdf, args.ocr)
+    else:
+        for mode in MODES:
+            subprocess.run(
+                [sys.executable, __file__, args.pdf, "--mode", mode]
+                + (["--ocr"] if args.ocr else []) + (["--planner"] if args.planner else []),
+                check=True
+            )
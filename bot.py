@@ -1,93 +1,146 @@
 import telebot
 from telebot.types import (
-    ReplyKeyboardMarkup,
-    KeyboardButton,
     InlineKeyboardMarkup,
-    InlineKeyboardButton,
-    ReplyKeyboardRemove
+    InlineKeyboardButton
 )
 import phonenumbers
 import time
 import os
 import re
-import threading
 import hashlib
-from fastapi import FastAPI, Request
+import functools
+import threading
+from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 import uvicorn
 from decouple import config
 # --- Database and other imports ---
 from database import (
-    get_db_connection, 
     initialize_db, 
+    close_pool,
+    stop_write_behind,
     register_user, 
-    add_points, 
     get_points, 
     user_exists, 
     add_user_language, 
     get_user_language, 
     record_timestamp, 
     store_invoice_in_db, 
-    get_invoice_from_db,
     set_user_state,
     get_user_state,
     read_name,
     get_name,
-    read_phone_number
+    read_phone_number,
+    clear_registration,
+    profile_cache_stats,
+    process_invoice
 )
 from pdf_analysis import handle_pdf_analysis
 from translations import translations
 from payment import generate_payment_link
+import update_queue
+import ocr
+import image_preprocess
+import pdf_extract
+import interpretation_cache
+import llm
+import catalog
+import timers
+import media_groups
+import keyboards
+import telegram_client
+from cache import LRUCache
 
 # ---------------------------------------
 TELEGRAM_BOT_TOKEN = config("TELEGRAM_BOT_TOKEN")
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+# Fork the preprocessing workers while this is still the only thread
+image_preprocess.start()
+# Outgoing API calls go through the pooled, rate-limited async client
+if config("TELEGRAM_ASYNC_CLIENT", default=True, cast=bool):
+    telegram_client.install()
+bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, threaded=False)
 app = FastAPI()
 initialize_db()
-user_data = {}
-user_data_lock = threading.Lock()
-languages = {
-    '🇬🇧 English': 'en',
-    '🇷🇺 Русский': 'ru',
-    '🇰🇿 Қазақша': 'kz'
-}
+catalog.start_listener()
+route_stats = {}
+route_stats_lock = threading.Lock()
+# Invoices already credited; the payment gateway retries notifications in bursts
+processed_invoices = LRUCache(max_entries=config("PROCESSED_INVOICES_CACHE", default=10000, cast=int))
+languages = keyboards.languages
 
 # ---------------------------------------
 # Helper functions
 # ---------------------------------------
 def send_message(user_id, message_key, reply_markup=None, parse_mode=None, disable_web_page_preview=None, **kwargs):
     user_language = get_user_language(user_id) 
+    # Sent as written: these strings are not templates and may contain braces
     message = translations[user_language][message_key]
     return bot.send_message(user_id, message, reply_markup=reply_markup, parse_mode=parse_mode, disable_web_page_preview=disable_web_page_preview, **kwargs)
 def send_localized_message(user_id, message_key, reply_markup=None, **kwargs):
     user_language = get_user_language(user_id)
-    message_template = translations[user_language].get(message_key, "Translation missing!")
-    message = message_template.format(**kwargs) 
+    message = keyboards.text(user_language, message_key, **kwargs)
     return bot.send_message(user_id, message, reply_markup=reply_markup)
 def language_selection_menu():
-    markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-    for language in languages.keys():
-        markup.add(KeyboardButton(language))
-    return markup
+    return keyboards.LANGUAGE_MENU
+def send_busy_message(chat_id):
+    try:
+        user_language = get_user_language(chat_id)
+        message = translations[user_language].get('busy', "The service is busy right now, please try again in a minute.")
+        bot.send_message(chat_id, message)
+    except Exception as e:
+        print(f"Error sending busy message to {chat_id}: {e}")
+def send_payment_message(user_id, points):
+    try:
+        user_language = get_user_language(user_id)
+        send_localized_message(user_id, 'successful_payment', points_based_on_product_id=points, reply_markup=keyboards.keyboard('analyse', user_language))
+    except Exception as e:
+        print(f"Error sending payment message to {user_id}: {e}")
+def record_route_latency(route, seconds):
+    with route_stats_lock:
+        stats = route_stats.setdefault(route, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['count'] += 1
+        stats['total_ms'] += seconds * 1000
+        stats['max_ms'] = max(stats['max_ms'], seconds * 1000)
+def get_route_stats():
+    with route_stats_lock:
+        return {
+            route: {**stats, 'avg_ms': round(stats['total_ms'] / stats['count'], 1)}
+            for route, stats in route_stats.items()
+        }
+def timed_route(route):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record_route_latency(route, time.perf_counter() - started)
+        return wrapper
+    return decorator
+def update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return None
 def is_valid_name(name):
     return re.match(r"^[A-Za-zÀ-ÖØ-öø-ÿА-Яа-яЁёҐґЇїІіЄє' -]+$", name.strip())
 
 @bot.message_handler(commands=['start'])
+@timed_route('start')
 def send_welcome(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
     record_timestamp(user_id)
-    inline_markup = InlineKeyboardMarkup()
-    for name, code in languages.items():
-        inline_markup.add(InlineKeyboardButton(name, callback_data=f"lang_{code}"))
     bot.send_message(
         message.chat.id, 
         "Please, choose the language:\n"
         "Пожалуйста, выберите язык:\n"
         "Өтініш, тілді таңдаңыз:", 
-        reply_markup=inline_markup
+        reply_markup=keyboards.LANGUAGE_CHOICE
     )
 
-@bot.message_handler(func=lambda message: message.text in ["/register", "📝Register", "📝Регистрация", "📝Тіркелу"])
 def ask_for_registration_info(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
@@ -95,13 +148,10 @@ def ask_for_registration_info(message):
     user_exist = user_exists(user_id)
     user_language = get_user_language(user_id)
     if user_exist and user_exist['name'] and user_exist['phone_number'] and user_exist['user_state'] == 0:
-        markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        markup.add(KeyboardButton(text=translations[user_language]['menu']))
-        send_message(message.chat.id, 'already_register', reply_markup=markup)
+        send_message(message.chat.id, 'already_register', reply_markup=keyboards.keyboard('menu', user_language))
     else:
-        remove_markup = telebot.types.ReplyKeyboardRemove()
         set_user_state(user_id, 1)
-        send_message(message.chat.id, 'ask_name', reply_markup=remove_markup, parse_mode='HTML')  
+        send_message(message.chat.id, 'ask_name', reply_markup=keyboards.REMOVE, parse_mode='HTML')  
 
 def process_name_step(message):
     bot.send_chat_action(message.chat.id, 'typing')
@@ -142,9 +192,7 @@ def process_phone_number_step(message):
     read_phone_number(user_id, formatted_phone_number)
     name = get_name(user_id)
     set_user_state(user_id, 3)
-    markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-    markup.add(KeyboardButton(text=translations[user_language]['correct']))
-    send_localized_message(message.chat.id, 'confirmation', name=name, formatted_phone_number=formatted_phone_number, reply_markup=markup)
+    send_localized_message(message.chat.id, 'confirmation', name=name, formatted_phone_number=formatted_phone_number, reply_markup=keyboards.keyboard('correct', user_language))
 
 def finalize_registration(message):
     chat_id = message.chat.id
@@ -160,14 +208,9 @@ def finalize_registration(message):
             cancel_timer(user_id)
             register_user(user_id=user_id, points_to_add=points_to_add)
             set_user_state(user_id, 0)
-            markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-            markup.add(KeyboardButton(text=translations[user_language]['analyse']))
-
-            send_message(chat_id, 'thanks_register', reply_markup=markup)
+            send_message(chat_id, 'thanks_register', reply_markup=keyboards.keyboard('analyse', user_language))
         except Exception as e:
-            markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-            markup.add(KeyboardButton(text=translations[user_language]['correct']))
-            send_message(chat_id, 'final_confirmation', reply_markup=markup)
+            send_message(chat_id, 'final_confirmation', reply_markup=keyboards.keyboard('correct', user_language))
             return
 
     elif message.text == '/cancel':
@@ -175,9 +218,7 @@ def finalize_registration(message):
         set_user_state(user_id, 0)
 
     else:
-        markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        markup.add(KeyboardButton(text=translations[user_language]['correct']))
-        send_message(chat_id, 'final_confirmation', reply_markup=markup)
+        send_message(chat_id, 'final_confirmation', reply_markup=keyboards.keyboard('correct', user_language))
 
 def cancel_registration(user_id):
     state = get_user_state(user_id)
@@ -189,40 +230,27 @@ def cancel_registration(user_id):
         cancel_timer(user_id)
         record_timestamp(user_id)
         user_language = get_user_language(user_id)
-        markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        markup.add(KeyboardButton(text=translations[user_language]['register']))
-        markup.add(KeyboardButton(text=translations[user_language]['menu']))
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("UPDATE user_points SET name = NULL, phone_number = NULL WHERE user_id = %s", (user_id,))
-        conn.commit()
-        c.close()
-        conn.close()
-        send_message(user_id, 'cancel_register', reply_markup=markup)
+        clear_registration(user_id)
+        send_message(user_id, 'cancel_register', reply_markup=keyboards.keyboard('register', user_language))
+
+timers.register(cancel_registration)
+# After every register(): overdue persisted timers fire as soon as the scheduler starts
+timers.start()
 
 def start_timer(user_id, duration_seconds, callback):
     try:
-        # print(user_id)
-        if user_id in user_data:
-            user_data[user_id].cancel()
-            del user_data[user_id]
-            # print(f"Deleted timer {user_id}")
-        timer = threading.Timer(duration_seconds, callback, args=(user_id,))
-        # print(f"Started timer {user_id}")
-        user_data[user_id] = timer
-        timer.start()
+        timers.schedule(callback.__name__, user_id, duration_seconds)
     except Exception as e:
         print(f"Error starting timer for user {user_id}: {e}")
 
 def cancel_timer(user_id):
     try:
-        if user_id in user_data:
-            user_data[user_id].cancel()
-            del user_data[user_id]
+        timers.cancel(cancel_registration.__name__, user_id)
     except Exception as e:
         print(f"Error canceling timer for user {user_id}: {e}")
 
 @bot.message_handler(commands=['language'])
+@timed_route('language')
 def language_command(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
@@ -230,7 +258,6 @@ def language_command(message):
     markup = language_selection_menu()
     bot.send_message(message.chat.id, "Please, choose the language:\nПожалуйста, выберите язык:\nӨтініш, тілді таңдаңыз:", reply_markup=markup)
 
-@bot.message_handler(func=lambda message: message.text in ["🇬🇧 English", "🇷🇺 Русский", "🇰🇿 Қазақша"])
 def handle_language_change(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
@@ -242,23 +269,14 @@ def handle_language_change(message):
 # ---------------------------------------
 # /analyse, /menu, /payment, /info, etc.
 # ---------------------------------------
-@bot.message_handler(func=lambda message: message.text in ["/analyse", "🔬 Analysis", "🔬 Анализировать", "🔬 Талдау"])
 def analyze_pdf(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
     record_timestamp(user_id)
     user_language = get_user_language(user_id)
 
-    inline_markup = InlineKeyboardMarkup()
-    inline_markup.row(InlineKeyboardButton(translations[user_language]['Send_photo'], callback_data="analyse_1"))
-    inline_markup.row(InlineKeyboardButton(translations[user_language]['Send_pdf_ios'], callback_data="analyse_2"))
-    inline_markup.row(InlineKeyboardButton(translations[user_language]['Send_pdf_android'], callback_data="analyse_3"))
-    inline_markup.row(InlineKeyboardButton(translations[user_language]['Send_screenshot'], callback_data="analyse_4"))
-
-
-    send_message(message.chat.id, 'analysis_explained', reply_markup=inline_markup, parse_mode='HTML')
+    send_message(message.chat.id, 'analysis_explained', reply_markup=keyboards.keyboard('analyse_options', user_language), parse_mode='HTML')
 
-@bot.message_handler(func=lambda message: message.text in [trans['info'] for trans in translations.values()])
 def show_info(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
@@ -266,95 +284,61 @@ def show_info(message):
     points = get_points(user_id)
     send_localized_message(message.chat.id, 'info_message', points=points)
 
-@bot.message_handler(func=lambda message: message.text in ["/menu", "🔗Menu", "🔗Меню", "🔗Мәзір"])
 def show_menu(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
     record_timestamp(user_id)
     user_language = get_user_language(user_id)
 
-    markup = ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    buttons = [
-        KeyboardButton(text=translations[user_language]['analyse']),
-        KeyboardButton(text=translations[user_language]['payment']),
-        KeyboardButton(text=translations[user_language]['instruction']),
-        KeyboardButton(text=translations[user_language]['info']),
-    ]
-    markup.add(*buttons)
-    send_message(message.chat.id, 'menu_text', reply_markup=markup)
-
-@bot.message_handler(func=lambda message: message.text in ["/payment", "💰 Top up balance", "💰 Пополнить баланс", "💰 Баланс толтыру"])
+    send_message(message.chat.id, 'menu_text', reply_markup=keyboards.keyboard('main_menu', user_language))
+
 def handle_payment(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
     record_timestamp(user_id)
     user_language = get_user_language(user_id)
 
-    products = [
-        {
-            "name": translations[user_language]['product_500']['name'],
-            "price": translations[user_language]['product_500']['price'],
-            "callback_data": "product_500"
-        },
-        {
-            "name": translations[user_language]['product_1000']['name'],
-            "price": translations[user_language]['product_1000']['price'],
-            "callback_data": "product_1000"
-        }
-    ]
-
-    inline_markup = InlineKeyboardMarkup()
-    for product in products:
-        btn_text = f"{product['name']} - {product['price']}"
-        button = InlineKeyboardButton(text=btn_text, callback_data=product['callback_data'])
-        inline_markup.add(button)
-
     send_message(
         message.chat.id,
         'payment_text',
-        reply_markup=inline_markup,
+        reply_markup=keyboards.keyboard('products', user_language),
         parse_mode='HTML',
         disable_web_page_preview=True
     )
 
-@bot.message_handler(func=lambda message: message.text in [trans['instruction'] for trans in translations.values()])
 def show_help(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
     record_timestamp(user_id)
     send_message(message.chat.id, 'help_text')
-group_handled = set()
 
 @bot.message_handler(content_types=['document'])
+@timed_route('document')
 def document_handler(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
     record_timestamp(user_id)
-    remove_markup = ReplyKeyboardRemove()
     if message.media_group_id:
-        if message.media_group_id not in group_handled:
-            group_handled.add(message.media_group_id)
-            send_message(message.chat.id, 'send_one', reply_markup=remove_markup)
+        if media_groups.first_seen(message.media_group_id):
+            send_message(message.chat.id, 'send_one', reply_markup=keyboards.REMOVE)
     else:
         if message.document.mime_type == 'application/pdf':
             handle_pdf_analysis(bot, message)
         else:
-            send_message(message.chat.id, 'send_pdf', reply_markup=remove_markup)
+            send_message(message.chat.id, 'send_pdf', reply_markup=keyboards.REMOVE)
 
 @bot.message_handler(content_types=['photo'])
+@timed_route('photo')
 def photo_handler(message):
     bot.send_chat_action(message.chat.id, 'typing')
     user_id = message.from_user.id
     record_timestamp(user_id)
     if message.media_group_id:
-        if message.media_group_id not in group_handled:
-            group_handled.add(message.media_group_id)
-            remove_markup = ReplyKeyboardRemove()
-            send_message(message.chat.id, 'send_one', reply_markup=remove_markup)
+        if media_groups.first_seen(message.media_group_id):
+            send_message(message.chat.id, 'send_one', reply_markup=keyboards.REMOVE)
     else:
         handle_pdf_analysis(bot, message)
 
-@bot.message_handler(func=lambda message: True)
 def handle_all_messages(message):
     user_id = message.from_user.id
     state = get_user_state(user_id)
@@ -366,11 +350,31 @@ def handle_all_messages(message):
         finalize_registration(message)
     else:
         user_language = get_user_language(user_id)
-        markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        markup.add(KeyboardButton(text=translations[user_language]['menu']))
-        send_message(message.chat.id, 'please_follow', reply_markup=markup)
+        send_message(message.chat.id, 'please_follow', reply_markup=keyboards.keyboard('menu', user_language))
+
+# Button and command text -> handler; anything else depends on the registration state
+MESSAGE_ROUTES = {
+    route: timed_route(route)(handler)
+    for route, handler in {
+        'register': ask_for_registration_info,
+        'language_change': handle_language_change,
+        'analyse': analyze_pdf,
+        'info': show_info,
+        'menu': show_menu,
+        'payment': handle_payment,
+        'instruction': show_help,
+    }.items()
+}
+# get_user_state reads the in-process profile cache before the database
+handle_state_message = timed_route('state')(handle_all_messages)
+
+@bot.message_handler(func=lambda message: True)
+def dispatch_message(message):
+    handler = MESSAGE_ROUTES.get(keyboards.route(message.text), handle_state_message)
+    handler(message)
 
 @bot.callback_query_handler(func=lambda call: True)
+@timed_route('callback')
 def callback_query(call):
     user_id = call.from_user.id
     record_timestamp(user_id)
@@ -415,38 +419,7 @@ def callback_query(call):
 
     elif call.data.startswith("specialist_"):
         specialist_name = call.data.split("_", 1)[1]
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("""
-            SELECT d.name, d.position, d.phone, d.medical_center, d.address, d.price, d.link
-            FROM doctors d
-            INNER JOIN specialists s ON d.position = s.name
-            WHERE s.name = %s
-        """, (specialist_name,))
-        rows = c.fetchall()
-        c.close()
-        conn.close()
-
-        if rows:
-            response = f"<b>Doctors for {specialist_name}:</b>\n"
-            for row in rows:
-                doctor_name = row[0]
-                position = row[1]
-                phone = row[2]
-                medical_center = row[3]
-                address = row[4]
-                price = row[5]
-                link = row[6]
-                response += (
-                    f"<b>Medical Center:</b> {medical_center}\n"
-                    f"<b>Name:</b> {doctor_name}\n"
-                    f"<b>Position:</b> {position}\n"
-                    f"<b>Phone:</b> {phone}\n"
-                    f"<b>Price:</b> {price} тг\n"
-                    f"<b>Address:</b> <a href='{link}'>{address}</a>\n\n"
-                )
-        else:
-            response = f"<b>No doctors found for {specialist_name}.</b>"
+        response = catalog.doctor_listing(specialist_name, user_language)
 
         bot.send_message(
             call.message.chat.id,
@@ -480,26 +453,17 @@ def callback_query(call):
         user_exist = user_exists(user_id)
         if user_exist and user_exist['name'] and user_exist['phone_number'] and user_exist['user_state'] == 0:
             # Already registered
-            markup = telebot.types.ReplyKeyboardMarkup(
-                one_time_keyboard=True, resize_keyboard=True
-            )
-            markup.add(KeyboardButton(text=translations[language_code]['analyse']))
             send_message(
                 call.message.chat.id, 
                 'welcome_back', 
-                reply_markup=markup
+                reply_markup=keyboards.keyboard('analyse', language_code)
             )
         else:
             # Not registered
-            markup = telebot.types.ReplyKeyboardMarkup(
-                one_time_keyboard=True, resize_keyboard=True
-            )
-            markup.add(KeyboardButton(text=translations[language_code]['register']))
-            markup.add(KeyboardButton(text=translations[language_code]['menu']))
             send_message(
                 call.message.chat.id, 
                 'welcome_register', 
-                reply_markup=markup
+                reply_markup=keyboards.keyboard('register', language_code)
             )
 
         # We also need to answer the callback so the "Loading..." disappears
@@ -514,7 +478,7 @@ def callback_query(call):
 # PAYMENT NOTIFICATION ENDPOINT
 # ---------------------------------------
 @app.api_route("/api/bot/payment", methods=["GET", "POST"])
-async def handle_payment_notification(request: Request):
+async def handle_payment_notification(request: Request, background_tasks: BackgroundTasks):
     data = dict(request.query_params)
     signature = data.get("SignatureValue")
     inv_id = data.get("InvId")
@@ -529,53 +493,84 @@ async def handle_payment_notification(request: Request):
         f"{out_sum}:{inv_id}:{os.getenv('MERCHANT_PASSWORD_2')}".encode('utf-8')
     ).hexdigest()
 
-    if signature.lower() != expected_signature.lower():
+    if not signature or signature.lower() != expected_signature.lower():
         return {"status": "fail", "reason": "Invalid signature"}
 
-    invoice = get_invoice_from_db(inv_id)
-    if not invoice:
-        return {"status": "fail", "reason": "Invoice not found"}
-    user_id, points, processed = invoice
-    if processed:
+    # Repeated notifications for the same invoice don't touch the database
+    if processed_invoices.get(inv_id):
         return {"status": "success", "reason": "Already processed"}
 
     try:
-        add_points(user_id, points)
-    except Exception:
+        status, user_id, points = await run_in_threadpool(process_invoice, inv_id)
+    except Exception as e:
+        print(f"Error processing invoice {inv_id}: {e}")
         return {"status": "fail", "reason": "Failed to add points"}
+    if status == 'missing':
+        return {"status": "fail", "reason": "Invoice not found"}
+    processed_invoices.set(inv_id, True)
+    if status == 'processed':
+        return {"status": "success", "reason": "Already processed"}
 
-    try:
-        user_language = get_user_language(user_id)
-        markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        markup.add(KeyboardButton(text=translations[user_language]['analyse']))
-        send_localized_message(user_id, 'successful_payment', points_based_on_product_id=points, reply_markup=markup)
-    except Exception:
-        return {"status": "fail", "reason": "Failed to send message"}
-
-    # Mark as processed
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("UPDATE invoices SET processed = TRUE WHERE invoice_id = %s", (inv_id,))
-    conn.commit()
-    c.close()
-    conn.close()
-
+    # Points are committed; tell the user after the response has been sent
+    background_tasks.add_task(send_payment_message, user_id, points)
     return {"status": "success"}
     
 # ---------------------------------------
 # TELEGRAM WEBHOOK
 # ---------------------------------------
 @app.post("/webhook/{secret_token}")
-async def telegram_webhook(request: Request, secret_token: str):
+async def telegram_webhook(request: Request, secret_token: str, background_tasks: BackgroundTasks):
     EXPECTED_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "SOME_RANDOM_SECRET")
     if secret_token != EXPECTED_SECRET:
         return {"status": "fail", "reason": "Invalid secret token"}
 
     body = await request.json()
     update = telebot.types.Update.de_json(body)
-    bot.process_new_updates([update])
+    chat_id = update_chat_id(update)
+    # Acknowledge right away; the update is processed by the worker pool
+    if not update_queue.submit(chat_id, bot.process_new_updates, [update]):
+        if chat_id is not None:
+            background_tasks.add_task(send_busy_message, chat_id)
+        return {"status": "busy"}
+    return {"status": "ok"}
+
+@app.get("/api/bot/metrics/{secret_token}")
+async def metrics(secret_token: str):
+    EXPECTED_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "SOME_RANDOM_SECRET")
+    if secret_token != EXPECTED_SECRET:
+        return {"status": "fail", "reason": "Invalid secret token"}
+    return {
+        "updates": update_queue.stats(),
+        "ocr": ocr.cache_stats(),
+        "pdf_images": pdf_extract.stats(),
+        "interpretations": interpretation_cache.stats(),
+        "llm": llm.stats(),
+        "profiles": profile_cache_stats(),
+        "catalog": catalog.stats(),
+        "timers": timers.stats(),
+        "media_groups": media_groups.stats(),
+        "routes": get_route_stats(),
+        "telegram": telegram_client.stats(),
+    }
+
+@app.post("/api/admin/cache/invalidate/{secret_token}")
+def invalidate_interpretation_cache(secret_token: str):
+    EXPECTED_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "SOME_RANDOM_SECRET")
+    if secret_token != EXPECTED_SECRET:
+        return {"status": "fail", "reason": "Invalid secret token"}
+    interpretation_cache.invalidate()
     return {"status": "ok"}
 
+@app.on_event("shutdown")
+def shutdown():
+    timers.stop()
+    update_queue.shutdown()
+    image_preprocess.shutdown()
+    telegram_client.stop()
+    catalog.stop_listener()
+    stop_write_behind()
+    close_pool()
+
 # ---------------------------------------
 # MAIN ENTRY POINT
 # ---------------------------------------
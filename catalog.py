@@ -0,0 +1,145 @@
+import select
+import threading
+import time
+from decouple import config
+
+from database import get_db_connection, get_doctor_catalog
+from translations import translations
+
+CATALOG_TTL = config("CATALOG_TTL", default=600, cast=int)
+CATALOG_LISTEN = config("CATALOG_LISTEN", default=True, cast=bool)
+CATALOG_CHANNEL = 'catalog_changed'
+
+_lock = threading.Lock()
+_catalog = None
+_version = 0
+# Bumped on every change notification; a catalog loaded before the last bump is stale
+_generation = 0
+_listener = None
+_listener_stopping = False
+
+def _render_listing(specialist_name, doctors, language):
+    strings = translations.get(language, {})
+    if not doctors:
+        return strings.get('no_doctors_found', "<b>No doctors found for {specialist}.</b>").format(specialist=specialist_name)
+    response = strings.get('doctors_for', "<b>Doctors for {specialist}:</b>\n").format(specialist=specialist_name)
+    card = strings.get(
+        'doctor_card',
+        "<b>Medical Center:</b> {medical_center}\n"
+        "<b>Name:</b> {name}\n"
+        "<b>Position:</b> {position}\n"
+        "<b>Phone:</b> {phone}\n"
+        "<b>Price:</b> {price} тг\n"
+        "<b>Address:</b> <a href='{link}'>{address}</a>\n\n"
+    )
+    for doctor_name, position, phone, medical_center, address, price, link in doctors:
+        response += card.format(
+            medical_center=medical_center,
+            name=doctor_name,
+            position=position,
+            phone=phone,
+            price=price,
+            address=address,
+            link=link
+        )
+    return response
+
+def _load():
+    global _catalog, _version
+    generation = _generation
+    doctors = {}
+    for specialist_name, doctor in get_doctor_catalog():
+        doctors.setdefault(specialist_name, [])
+        if doctor is not None:
+            doctors[specialist_name].append(doctor)
+    listings = {
+        (specialist_name, language): _render_listing(specialist_name, specialist_doctors, language)
+        for specialist_name, specialist_doctors in doctors.items()
+        for language in translations
+    }
+    _version += 1
+    _catalog = {
+        'version': _version,
+        'generation': generation,
+        'loaded_at': time.monotonic(),
+        'specialists': list(doctors),
+        'listings': listings,
+    }
+    return _catalog
+
+def _is_stale(catalog):
+    return (
+        catalog is None
+        or catalog['generation'] != _generation
+        or time.monotonic() - catalog['loaded_at'] > CATALOG_TTL
+    )
+
+def get_catalog():
+    catalog = _catalog
+    if _is_stale(catalog):
+        with _lock:
+            catalog = _catalog
+            if _is_stale(catalog):
+                catalog = _load()
+    return catalog
+
+def invalidate():
+    global _generation
+    _generation += 1
+
+def get_specialists():
+    return get_catalog()['specialists']
+
+def doctor_listing(specialist_name, language):
+    """Pre-rendered HTML list of doctors for a specialist."""
+    listing = get_catalog()['listings'].get((specialist_name, language))
+    if listing is None:
+        listing = _render_listing(specialist_name, [], language)
+    return listing
+
+def stats():
+    catalog = _catalog
+    if catalog is None:
+        return {'version': _version, 'loaded': False}
+    return {
+        'version': catalog['version'],
+        'loaded': True,
+        'stale': _is_stale(catalog),
+        'age': round(time.monotonic() - catalog['loaded_at'], 1),
+        'specialists': len(catalog['specialists']),
+    }
+
+# Drop the catalog whenever the database sends a change notification
+def _listen():
+    while not _listener_stopping:
+        conn = None
+        try:
+            conn = get_db_connection()
+            conn.autocommit = True
+            with conn.cursor() as c:
+                c.execute(f"LISTEN {CATALOG_CHANNEL};")
+            # Changes made while we were not listening
+            invalidate()
+            while not _listener_stopping:
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    invalidate()
+        except Exception as e:
+            print(f"Catalog listener error: {e}")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()
+
+def start_listener():
+    global _listener
+    if CATALOG_LISTEN and _listener is None:
+        _listener = threading.Thread(target=_listen, name="catalog-listener", daemon=True)
+        _listener.start()
+
+def stop_listener():
+    global _listener_stopping
+    _listener_stopping = True
@@ -1,288 +1,581 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from psycopg2.extras import Json, execute_values
+import atexit
+import datetime
+import threading
+import time
 import urllib.parse as urlparse
+from collections import Counter
+from contextlib import contextmanager
 from decouple import config
 from dotenv import load_dotenv
 
+from cache import LRUCache
+from migrations import run_migrations
+
 load_dotenv()
 
-# Get a database connection
+DB_POOL_MIN = config("DB_POOL_MIN", default=1, cast=int)
+DB_POOL_MAX = config("DB_POOL_MAX", default=10, cast=int)
+DB_POOL_HEALTHCHECK = config("DB_POOL_HEALTHCHECK", default=True, cast=bool)
+# Only connections idle for longer than this are pinged before use; broken ones are discarded on error anyway
+DB_POOL_HEALTHCHECK_IDLE = config("DB_POOL_HEALTHCHECK_IDLE", default=60.0, cast=float)
+PROFILE_CACHE_TTL = config("PROFILE_CACHE_TTL", default=300, cast=int)
+PROFILE_CACHE_MAX_ENTRIES = config("PROFILE_CACHE_MAX_ENTRIES", default=10000, cast=int)
+WRITE_BEHIND_INTERVAL = config("WRITE_BEHIND_INTERVAL", default=5.0, cast=float)
+ACTIVITY_FLUSH_SIZE = config("ACTIVITY_FLUSH_SIZE", default=500, cast=int)
+# Buffer specialist recommendation counts and flush them with the other write-behind data
+REC_COUNT_WRITE_BEHIND = config("REC_COUNT_WRITE_BEHIND", default=True, cast=bool)
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_connection_params = None
+_returned_at = {}  # pooled connection -> monotonic time it was last returned to the pool
+# user_id -> profile dict, see get_user_profile()
+_profiles = LRUCache(max_entries=PROFILE_CACHE_MAX_ENTRIES, ttl=PROFILE_CACHE_TTL)
+# user_id -> (write sequence, monotonic time) of the last profile write; a load that
+# started before it must not cache what it read, see get_user_profile()
+_profile_lock = threading.Lock()
+_profile_writes = {}
+_profile_write_seq = 0
+# Write-behind buffers, flushed by a background thread, see flush_pending_writes()
+_pending_lock = threading.Lock()
+_pending_timestamps = {}  # user_id -> (first_seen, last_seen)
+_pending_rec_counts = Counter()  # specialist name -> recommendations not yet written
+_flush_wakeup = threading.Event()
+_flush_thread = None
+_flush_stopping = False
+
+# Parse DATABASE_URL once
+def get_connection_params():
+    global _connection_params
+    if _connection_params is None:
+        DATABASE_URL = config("DATABASE_URL")
+        if not DATABASE_URL:
+            raise RuntimeError("DATABASE_URL is not provided. Cannot connect to the database.")
+
+        urlparse.uses_netloc.append("postgres")
+        url = urlparse.urlparse(DATABASE_URL)
+        _connection_params = {
+            'database': url.path[1:],
+            'user': url.username,
+            'password': url.password,
+            'host': url.hostname,
+            'port': url.port
+        }
+    return _connection_params
+
+# Get a dedicated (non-pooled) database connection
 def get_db_connection():
-    DATABASE_URL = config("DATABASE_URL")
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL is not provided. Cannot connect to the database.")
-
-    urlparse.uses_netloc.append("postgres")
-    url = urlparse.urlparse(DATABASE_URL)
-    conn = psycopg2.connect(
-        database=url.path[1:],
-        user=url.username,
-        password=url.password,
-        host=url.hostname,
-        port=url.port
-    )
-    return conn
-
-# Initialize the database
+    return psycopg2.connect(**get_connection_params())
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **get_connection_params())
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _returned_at.clear()
+            _pool = None
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if not DB_POOL_HEALTHCHECK:
+        return True
+    returned_at = _returned_at.get(conn)
+    if returned_at is not None and time.monotonic() - returned_at < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as c:
+            c.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _checkout(pool):
+    # A stale connection is discarded and replaced by a fresh one
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+        _returned_at.pop(conn, None)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("Could not get a healthy connection from the pool")
+
+# Borrow a pooled connection; commits on success, rolls back on error
+@contextmanager
+def db_connection():
+    _pool_slots.acquire()
+    try:
+        pool = get_pool()
+        conn = _checkout(pool)
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            close = broken or bool(conn.closed)
+            if close:
+                _returned_at.pop(conn, None)
+            else:
+                _returned_at[conn] = time.monotonic()
+            pool.putconn(conn, close=close)
+    finally:
+        _pool_slots.release()
+
+@contextmanager
+def db_cursor():
+    with db_connection() as conn:
+        with conn.cursor() as c:
+            yield c
+
+# Initialize the database (applies pending schema migrations)
 def initialize_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS user_points (
-              user_id BIGINT PRIMARY KEY, 
-              points BIGINT,
-              name VARCHAR(255),
-              phone VARCHAR(225),
-              language VARCHAR(10),
-              first_time TIMESTAMP DEFAULT NULL,
-              last_time TIMESTAMP DEFAULT NULL,
-              user_state BIGINT DEFAULT 0
-            );
-              
-            
-            CREATE TABLE IF NOT EXISTS specialists (
-                id SERIAL PRIMARY KEY,          -- Unique ID for the specialization
-                name VARCHAR(255) NOT NULL,     -- Name of the specialization
-                rec_count INT DEFAULT 0         -- Recommendation counter
-            );
-
-            
-            CREATE TABLE IF NOT EXISTS doctors (
-                id BIGSERIAL PRIMARY KEY, -- Unique identifier for each doctor
-                specialist_id INT REFERENCES specialists(id),
-                name VARCHAR(255),               -- Doctor's full name
-                position VARCHAR(255),           -- Doctor's job title
-                phone VARCHAR(20),        -- Doctor's contact number
-                medical_center VARCHAR(255) DEFAULT NULL,    -- The organization the doctor works for
-                address VARCHAR(255) DEFAULT NULL,           -- The address of the medical center
-                price INT DEFAULT NULL
-            );
-              
-            CREATE TABLE IF NOT EXISTS invoices (
-                invoice_id BIGINT PRIMARY KEY,  -- Unique invoice ID
-                user_id BIGINT REFERENCES user_points(user_id) ON DELETE CASCADE,
-                product_id VARCHAR(255),
-                points BIGINT,
-                price INT,
-                processed BOOLEAN DEFAULT FALSE,
-                time TIMESTAMP DEFAULT NULL
-            );
-            
-        ''')
-    conn.commit()
-    conn.close()
+    with db_cursor() as c:
+        run_migrations(c)
+
+# User profile: everything the handlers read about a user, loaded with one query
+def get_user_profile(user_id):
+    profile = _profiles.get(user_id)
+    if profile is None:
+        loaded_after = _profile_write_seq
+        with db_cursor() as c:
+            c.execute(
+                'SELECT language, user_state, points, name, phone_number FROM user_points WHERE user_id = %s',
+                (user_id,)
+            )
+            result = c.fetchone()
+        if result:
+            profile = {
+                'exists': True,
+                'language': result[0],
+                'user_state': result[1],
+                'points': result[2],
+                'name': result[3],
+                'phone_number': result[4],
+            }
+        else:
+            profile = {'exists': False}
+        with _profile_lock:
+            # Skip caching if the user was written to while we were reading
+            if _profile_writes.get(user_id, (0, 0))[0] <= loaded_after:
+                _profiles.set(user_id, profile)
+    return profile
+
+def _profile_written(user_id):
+    global _profile_write_seq
+    _profile_write_seq += 1
+    now = time.monotonic()
+    _profile_writes[user_id] = (_profile_write_seq, now)
+    if len(_profile_writes) > PROFILE_CACHE_MAX_ENTRIES:
+        # No load still in flight started this long ago
+        for key in [key for key, (_, written_at) in _profile_writes.items() if now - written_at > 60]:
+            del _profile_writes[key]
+
+# Write-through: update the cached profile after a write, or drop it if it can't be updated
+def _update_profile(user_id, **fields):
+    with _profile_lock:
+        _profile_written(user_id)
+        profile = _profiles.peek(user_id)
+        if profile is not None and profile['exists']:
+            _profiles.set(user_id, {**profile, **fields})
+        else:
+            _profiles.delete(user_id)
+
+def invalidate_user_profile(user_id):
+    with _profile_lock:
+        _profile_written(user_id)
+        _profiles.delete(user_id)
+
+def profile_cache_stats():
+    return _profiles.stats()
 
 #Read name
 def read_name(user_id, name):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('UPDATE user_points SET name = %s WHERE user_id = %s', (name, user_id))
-    conn.commit()
-    c.close()
-    conn.close()
+    with db_cursor() as c:
+        c.execute('UPDATE user_points SET name = %s WHERE user_id = %s', (name, user_id))
+    _update_profile(user_id, name=name)
 
 def get_name(user_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT name FROM user_points WHERE user_id = %s', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    if result and result[0] is not None:
-        return result[0]
+    profile = get_user_profile(user_id)
+    if profile['exists'] and profile['name'] is not None:
+        return profile['name']
     else:
         return 0 
 
 #Read phone number
 def read_phone_number(user_id, phone_number):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('UPDATE user_points SET phone_number = %s WHERE user_id = %s', (phone_number, user_id))
-    conn.commit()
-    c.close()
-    conn.close()
+    with db_cursor() as c:
+        c.execute('UPDATE user_points SET phone_number = %s WHERE user_id = %s', (phone_number, user_id))
+    _update_profile(user_id, phone_number=phone_number)
+
+# Clear registration data
+def clear_registration(user_id):
+    with db_cursor() as c:
+        c.execute("UPDATE user_points SET name = NULL, phone_number = NULL WHERE user_id = %s", (user_id,))
+    _update_profile(user_id, name=None, phone_number=None)
 
 # Registration 
 def register_user(user_id, points_to_add):
-    conn = get_db_connection()
-    # print(f"Registering user: {user_id}, Points to add: {points_to_add}, Name: {name}, Phone Number: {phone_number}")
-    c = conn.cursor()
     sql = """
     INSERT INTO user_points (user_id, points) VALUES (%s, %s)
     ON CONFLICT (user_id) DO UPDATE SET
-        points = COALESCE(user_points.points, 0) + EXCLUDED.points;
+        points = COALESCE(user_points.points, 0) + EXCLUDED.points
+    RETURNING points;
     """
-    c.execute(sql, (user_id, points_to_add))
-    conn.commit()
-    c.close()
-    conn.close()
+    with db_cursor() as c:
+        c.execute(sql, (user_id, points_to_add))
+        points = c.fetchone()[0]
+    _update_profile(user_id, points=points)
 
 # Add points
 def add_points(user_id, points_to_add):
-    conn = get_db_connection()
-    c = conn.cursor()
     sql = """
     INSERT INTO user_points (user_id, points) VALUES (%s, %s)
-    ON CONFLICT (user_id) DO UPDATE SET points = COALESCE(user_points.points, 0) + EXCLUDED.points;
+    ON CONFLICT (user_id) DO UPDATE SET points = COALESCE(user_points.points, 0) + EXCLUDED.points
+    RETURNING points;
     """
-    c.execute(sql, (user_id, points_to_add))
-    conn.commit()
-    c.close()
-    conn.close()
-
-# Subtract points
-def subtract_points(user_id, points_to_subtract):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT points FROM user_points WHERE user_id = %s', (user_id,))
-    result = c.fetchone()
-    if result and result[0] >= points_to_subtract:
-        c.execute('UPDATE user_points SET points = points - %s WHERE user_id = %s', (points_to_subtract, user_id))
-        conn.commit()
-        conn.close()
-        return True  # Successfully subtracted points
-    else:
-        conn.close()
-        return False  # Not enough points or user not found
+    with db_cursor() as c:
+        c.execute(sql, (user_id, points_to_add))
+        points = c.fetchone()[0]
+    _update_profile(user_id, points=points)
+
+# Reserve points: debit them in one statement, only if the balance covers it.
+# Returns the remaining balance, or None if there were not enough points.
+# The reservation is kept by doing nothing, or refunded with release_points().
+def reserve_points(user_id, points_to_reserve):
+    with db_cursor() as c:
+        c.execute(
+            'UPDATE user_points SET points = points - %s WHERE user_id = %s AND points >= %s RETURNING points',
+            (points_to_reserve, user_id, points_to_reserve)
+        )
+        result = c.fetchone()
+    if result is None:
+        return None
+    _update_profile(user_id, points=result[0])
+    return result[0]
+
+# Refund a reservation
+def release_points(user_id, points_to_release):
+    add_points(user_id, points_to_release)
 
 # Get user points
 def get_points(user_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT points FROM user_points WHERE user_id = %s', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    if result and result[0] is not None:
-        return result[0]
+    profile = get_user_profile(user_id)
+    if profile['exists'] and profile['points'] is not None:
+        return profile['points']
     else:
         return 0  # Return 0 points if user is not found or points are NULL
 
 # Check if user exists
 def user_exists(user_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    with conn.cursor() as cursor:
-        cursor.execute('SELECT name, phone_number, user_state FROM user_points WHERE user_id = %s', (user_id,))
-        result = cursor.fetchone()
-    conn.close()
-    if result:
-        return {'name': result[0], 'phone_number': result[1], 'user_state': result[2]}
+    profile = get_user_profile(user_id)
+    if profile['exists']:
+        return {'name': profile['name'], 'phone_number': profile['phone_number'], 'user_state': profile['user_state']}
     return None
 
 # Add user language
 def add_user_language(user_id, language_code):
-    conn = get_db_connection()
-    c = conn.cursor()
     sql = """
     INSERT INTO user_points (user_id, language) VALUES (%s, %s)
     ON CONFLICT (user_id) DO UPDATE SET language = EXCLUDED.language;
     """
-    c.execute(sql, (user_id, language_code))
-    conn.commit()
-    c.close()
-    conn.close()
+    with db_cursor() as c:
+        c.execute(sql, (user_id, language_code))
+    _update_profile(user_id, language=language_code)
 
 # Get user language
 def get_user_language(user_id):
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT language FROM user_points WHERE user_id = %s", (user_id,))
-            result = cur.fetchone()
-            if result:
-                return result[0]  # Return the language code stored in the database
-            else:
-                return 'en'  # Default to English if no language is set
+        profile = get_user_profile(user_id)
+        if profile['exists']:
+            return profile['language']  # Return the language code stored in the database
+        else:
+            return 'en'  # Default to English if no language is set
     except Exception as e:
         print(f"Database error: {e}")
         return 'en'  # Default to English in case of any error
-    finally:
-        conn.close()
 
-# Timestamp
+# Timestamp, buffered in memory and written by flush_timestamps()
 def record_timestamp(user_id):
-    conn = get_db_connection()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with _pending_lock:
+        first_seen = _pending_timestamps.get(user_id, (now, now))[0]
+        _pending_timestamps[user_id] = (first_seen, now)
+        pending = len(_pending_timestamps)
+    start_write_behind()
+    if pending >= ACTIVITY_FLUSH_SIZE:
+        _flush_wakeup.set()
+
+def flush_timestamps():
+    global _pending_timestamps
+    with _pending_lock:
+        batch, _pending_timestamps = _pending_timestamps, {}
+    if not batch:
+        return
+    # Sorted so concurrent flushes from several processes lock rows in the same order
+    rows = [(user_id, first_seen, last_seen) for user_id, (first_seen, last_seen) in sorted(batch.items())]
     try:
-        c = conn.cursor()
-        # Use INSERT ON CONFLICT to handle the unique constraint on user_id
-        c.execute('''
-            INSERT INTO user_points (user_id, first_time, last_time)
-            VALUES (%s, CURRENT_TIMESTAMP AT TIME ZONE 'UTC' AT TIME ZONE 'UTC+5', CURRENT_TIMESTAMP AT TIME ZONE 'UTC' AT TIME ZONE 'UTC+5')
-            ON CONFLICT (user_id) DO UPDATE
-            SET last_time = EXCLUDED.last_time
-            ''', (user_id,))
-        conn.commit()
+        with db_cursor() as c:
+            execute_values(c, '''
+                INSERT INTO user_points (user_id, first_time, last_time)
+                VALUES %s
+                ON CONFLICT (user_id) DO UPDATE
+                SET last_time = GREATEST(user_points.last_time, EXCLUDED.last_time)
+                ''', rows,
+                template="(%s, %s::timestamptz AT TIME ZONE 'UTC' AT TIME ZONE 'UTC+5', %s::timestamptz AT TIME ZONE 'UTC' AT TIME ZONE 'UTC+5')")
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        c.close()
-        conn.close()
-
-def get_all_specialists():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT Name FROM specialists')
-    result = [row[0] for row in c.fetchall()]  # Extract the first column from each tuple
-    c.close()
-    conn.close()
-    return result
-
-def increment_rec_count(specialist_name):
+        print(f"An error occurred while flushing timestamps: {e}")
+        # Put the batch back, merged with anything recorded in the meantime
+        with _pending_lock:
+            for user_id, (first_seen, last_seen) in batch.items():
+                newer = _pending_timestamps.get(user_id)
+                _pending_timestamps[user_id] = (first_seen, newer[1] if newer else last_seen)
+        return
+    for user_id in batch:
+        # The row may have just been created
+        if not _profiles.peek(user_id, {'exists': True})['exists']:
+            invalidate_user_profile(user_id)
+
+def flush_pending_writes():
+    flush_timestamps()
+    flush_rec_counts()
+
+def _flush_loop():
+    while not _flush_stopping:
+        _flush_wakeup.wait(WRITE_BEHIND_INTERVAL)
+        _flush_wakeup.clear()
+        flush_pending_writes()
+
+def start_write_behind():
+    global _flush_thread
+    if _flush_thread is None:
+        with _pending_lock:
+            if _flush_thread is None and not _flush_stopping:
+                _flush_thread = threading.Thread(target=_flush_loop, name="write-behind", daemon=True)
+                _flush_thread.start()
+
+# Stop the background flusher and write out everything still buffered
+def stop_write_behind():
+    global _flush_stopping
+    _flush_stopping = True
+    _flush_wakeup.set()
+    if _flush_thread is not None:
+        _flush_thread.join()
+    flush_pending_writes()
+    with _pending_lock:
+        if _pending_rec_counts:
+            # Last resort so the counts can be applied by hand
+            print(f"Unwritten specialist recommendation counts: {dict(_pending_rec_counts)}")
+
+atexit.register(stop_write_behind)
+
+# Add recommendations to several specialists with one statement
+def increment_rec_counts(counts):
+    rows = sorted(counts.items())
+    if not rows:
+        return
+    with db_cursor() as c:
+        execute_values(c, """
+            UPDATE specialists AS s SET rec_count = COALESCE(s.rec_count, 0) + v.delta
+            FROM (VALUES %s) AS v(name, delta)
+            WHERE s.name = v.name
+        """, rows)
+
+# Count one recommendation for each specialist of an analysis
+def record_specialist_recommendations(specialist_names):
+    counts = Counter(specialist_names)
+    if REC_COUNT_WRITE_BEHIND:
+        with _pending_lock:
+            _pending_rec_counts.update(counts)
+        start_write_behind()
+        return
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("UPDATE specialists SET rec_count = rec_count + 1 WHERE Name = %s;", (specialist_name,))
-        conn.commit()
+        increment_rec_counts(counts)
     except Exception as e:
         print(f"An error occurred: {e}")
-    finally:
-        c.close()
-        conn.close()
+
+def flush_rec_counts():
+    global _pending_rec_counts
+    with _pending_lock:
+        counts, _pending_rec_counts = _pending_rec_counts, Counter()
+    try:
+        increment_rec_counts(counts)
+    except Exception as e:
+        print(f"An error occurred while flushing recommendation counts: {e}")
+        with _pending_lock:
+            _pending_rec_counts.update(counts)
+
+# Every specialist with its doctors, (specialist_name, None) for specialists without doctors
+def get_doctor_catalog():
+    with db_cursor() as c:
+        c.execute("""
+            SELECT s.name, d.name, d.position, d.phone, d.medical_center, d.address, d.price, d.link
+            FROM specialists s
+            LEFT JOIN doctors d ON d.position = s.name
+            ORDER BY s.id, d.id
+        """)
+        rows = c.fetchall()
+    return [(row[0], row[1:] if row[2] is not None else None) for row in rows]
+
+def get_cached_ocr(image_hash):
+    with db_cursor() as c:
+        c.execute("SELECT text FROM ocr_cache WHERE image_hash = %s", (image_hash,))
+        result = c.fetchone()
+    return result[0] if result else None
+
+def store_cached_ocr(image_hash, text):
+    with db_cursor() as c:
+        c.execute(
+            "INSERT INTO ocr_cache (image_hash, text) VALUES (%s, %s) ON CONFLICT (image_hash) DO NOTHING",
+            (image_hash, text),
+        )
+
+# Keep only the newest max_rows cached OCR results
+def prune_ocr_cache(max_rows):
+    with db_cursor() as c:
+        c.execute("""
+            DELETE FROM ocr_cache WHERE image_hash IN (
+                SELECT image_hash FROM ocr_cache ORDER BY created_at DESC OFFSET %s
+            )
+        """, (max_rows,))
+
+def get_cached_interpretation(cache_key):
+    with db_cursor() as c:
+        c.execute(
+            "SELECT data FROM interpretation_cache WHERE cache_key = %s AND expires_at > CURRENT_TIMESTAMP",
+            (cache_key,),
+        )
+        result = c.fetchone()
+    return result[0] if result else None
+
+def store_cached_interpretation(cache_key, data, ttl_seconds):
+    with db_cursor() as c:
+        c.execute("""
+            INSERT INTO interpretation_cache (cache_key, data, expires_at)
+            VALUES (%s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+            ON CONFLICT (cache_key) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+        """, (cache_key, Json(data), ttl_seconds))
+
+def delete_expired_interpretations():
+    with db_cursor() as c:
+        c.execute("DELETE FROM interpretation_cache WHERE expires_at <= CURRENT_TIMESTAMP")
+
+def clear_interpretation_cache():
+    with db_cursor() as c:
+        c.execute("DELETE FROM interpretation_cache")
 
 def store_invoice_in_db(invoice_id, user_id, product_id, points, price):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT INTO invoices (invoice_id, user_id, product_id, points, price, processed, time)
-        VALUES (%s, %s, %s, %s, %s, FALSE, CURRENT_TIMESTAMP AT TIME ZONE 'UTC' AT TIME ZONE 'UTC+5')
-        """,
-        (invoice_id, user_id, product_id, points, price),
-    )
-    conn.commit()
-    c.close()
-    conn.close()
-
-def get_invoice_from_db(invoice_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT user_id, points, processed FROM invoices WHERE invoice_id = %s", (invoice_id,))
-    result = c.fetchone()
-    c.close()
-    conn.close()
-    return result
+    with db_cursor() as c:
+        c.execute(
+            """
+            INSERT INTO invoices (invoice_id, user_id, product_id, points, price, processed, time)
+            VALUES (%s, %s, %s, %s, %s, FALSE, CURRENT_TIMESTAMP AT TIME ZONE 'UTC' AT TIME ZONE 'UTC+5')
+            """,
+            (invoice_id, user_id, product_id, points, price),
+        )
+
+# Mark the invoice processed and credit its points in one transaction.
+# Returns ('credited', user_id, points), ('processed', None, None) if an earlier
+# notification already did it, or ('missing', None, None) for an unknown invoice.
+def process_invoice(invoice_id):
+    with db_cursor() as c:
+        c.execute(
+            "UPDATE invoices SET processed = TRUE WHERE invoice_id = %s AND processed = FALSE RETURNING user_id, points",
+            (invoice_id,)
+        )
+        invoice = c.fetchone()
+        if invoice is None:
+            c.execute("SELECT 1 FROM invoices WHERE invoice_id = %s", (invoice_id,))
+            return ('processed' if c.fetchone() else 'missing'), None, None
+        user_id, points = invoice
+        c.execute(
+            """
+            INSERT INTO user_points (user_id, points) VALUES (%s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET points = COALESCE(user_points.points, 0) + EXCLUDED.points
+            RETURNING points;
+            """,
+            (user_id, points)
+        )
+        balance = c.fetchone()[0]
+    _update_profile(user_id, points=balance)
+    return 'credited', user_id, points
+
+def save_timer(kind, key, due_at):
+    with db_cursor() as c:
+        c.execute(
+            """
+            INSERT INTO timers (kind, key, due_at) VALUES (%s, %s, %s)
+            ON CONFLICT (kind, key) DO UPDATE SET due_at = EXCLUDED.due_at
+            """,
+            (kind, key, due_at)
+        )
+
+def delete_timer(kind, key):
+    with db_cursor() as c:
+        c.execute("DELETE FROM timers WHERE kind = %s AND key = %s", (kind, key))
+
+# Remove a timer that fired; False if it was rescheduled, cancelled or already claimed by another process
+def claim_timer(kind, key, due_at):
+    with db_cursor() as c:
+        c.execute("DELETE FROM timers WHERE kind = %s AND key = %s AND due_at = %s RETURNING 1", (kind, key, due_at))
+        return c.fetchone() is not None
+
+def load_timers():
+    with db_cursor() as c:
+        c.execute("SELECT kind, key, due_at FROM timers")
+        return c.fetchall()
+
+# True if this is the first time any bot process saw the media group
+def claim_media_group(media_group_id):
+    with db_cursor() as c:
+        c.execute(
+            "INSERT INTO media_groups (media_group_id) VALUES (%s) ON CONFLICT DO NOTHING RETURNING 1",
+            (media_group_id,)
+        )
+        return c.fetchone() is not None
+
+def prune_media_groups(ttl_seconds):
+    with db_cursor() as c:
+        c.execute("DELETE FROM media_groups WHERE seen_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'", (ttl_seconds,))
 
 def set_user_state(user_id, state):
-    conn = get_db_connection()
-    c = conn.cursor()
     sql = """
     INSERT INTO user_points (user_id, user_state) VALUES (%s, %s)
     ON CONFLICT (user_id) DO UPDATE SET user_state = EXCLUDED.user_state;
     """
-    c.execute(sql, (user_id, state))
-    conn.commit()
-    c.close()
-    conn.close()
+    with db_cursor() as c:
+        c.execute(sql, (user_id, state))
+    _update_profile(user_id, user_state=state)
 
 def get_user_state(user_id):
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT user_state FROM user_points WHERE user_id = %s", (user_id,))
-            result = cur.fetchone()
-            if result:
-                return result[0]  # Return the user_state stored in the database
-            else:
-                return '0'  # Default to English if no language is set
+        profile = get_user_profile(user_id)
+        if profile['exists']:
+            return profile['user_state']  # Return the user_state stored in the database
+        else:
+            return '0'  # Default to English if no language is set
     except Exception as e:
         print(f"Database error: {e}")
         return 'en'  # Default to English in case of any error
-    finally:
-        conn.close()
\ No newline at end of file
@@ -0,0 +1,92 @@
+import io
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from decouple import config
+from PIL import Image, ImageOps
+
+OCR_PREPROCESS = config("OCR_PREPROCESS", default=True, cast=bool)
+OCR_PREPROCESS_WORKERS = config("OCR_PREPROCESS_WORKERS", default=2, cast=int)
+OCR_PREPROCESS_TIMEOUT = config("OCR_PREPROCESS_TIMEOUT", default=30, cast=int)
+# Smaller images are sent as they are, re-encoding them saves nothing
+OCR_PREPROCESS_MIN_BYTES = config("OCR_PREPROCESS_MIN_BYTES", default=150_000, cast=int)
+# Longest side sent to OCR; lab report text stays readable well below scan resolution
+OCR_MAX_SIDE = config("OCR_MAX_SIDE", default=2048, cast=int)
+OCR_JPEG_QUALITY = config("OCR_JPEG_QUALITY", default=85, cast=int)
+
+_executor = None
+_executor_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {'images': 0, 'reencoded': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+def preprocess_image(image_bytes, max_side=OCR_MAX_SIDE, quality=OCR_JPEG_QUALITY):
+    """Downscale to max_side, convert to grayscale and re-encode as JPEG.
+
+    Runs in a worker process. Returns the original bytes if the result is not smaller.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("L")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    result = output.getvalue()
+    return result if len(result) < len(image_bytes) else image_bytes
+
+def start():
+    """Fork the worker processes; call before the process starts any other thread.
+
+    A fork copies only the calling thread, so a lock another thread holds at that
+    moment stays locked in the worker forever and its tasks time out.
+    """
+    global _executor
+    if not OCR_PREPROCESS:
+        return
+    with _executor_lock:
+        if _executor is None:
+            # Default start method: spawn would re-run bot.py's startup in every worker.
+            # The first task makes the pool fork all of its workers at once.
+            _executor = ProcessPoolExecutor(max_workers=OCR_PREPROCESS_WORKERS)
+            _executor.submit(int).result()
+
+def _reset_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+
+def _count(**amounts):
+    with _stats_lock:
+        for name, amount in amounts.items():
+            _stats[name] += amount
+
+def prepare_image(image_bytes):
+    """Bytes to upload for OCR; the original bytes if preprocessing is off, not worth it or fails."""
+    if not OCR_PREPROCESS or len(image_bytes) < OCR_PREPROCESS_MIN_BYTES:
+        return image_bytes
+    executor = _executor
+    if executor is None:
+        return image_bytes
+    try:
+        result = executor.submit(preprocess_image, image_bytes).result(timeout=OCR_PREPROCESS_TIMEOUT)
+    except Exception as e:
+        print(f"Image preprocessing error: {e}")
+        if isinstance(e, BrokenProcessPool):
+            # A worker died (e.g. out of memory on a huge scan). Forking a new pool from the
+            # running, threaded process is unsafe, so preprocessing stays off until restart.
+            _reset_executor(executor)
+        _count(images=1, errors=1, bytes_in=len(image_bytes), bytes_out=len(image_bytes))
+        return image_bytes
+    _count(images=1, reencoded=int(result is not image_bytes), bytes_in=len(image_bytes), bytes_out=len(result))
+    return result
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import re
+import threading
+from decouple import config
+
+from cache import LRUCache
+from database import (
+    get_cached_interpretation,
+    store_cached_interpretation,
+    delete_expired_interpretations,
+    clear_interpretation_cache
+)
+
+INTERPRETATION_CACHE_TTL = config("INTERPRETATION_CACHE_TTL", default=24 * 3600, cast=int)
+INTERPRETATION_CACHE_MAX_ENTRIES = config("INTERPRETATION_CACHE_MAX_ENTRIES", default=1000, cast=int)
+INTERPRETATION_CACHE_PERSISTENT = config("INTERPRETATION_CACHE_PERSISTENT", default=False, cast=bool)
+# Bump when prompts or models change so that old interpretations are no longer served
+INTERPRETATION_CACHE_VERSION = config("INTERPRETATION_CACHE_VERSION", default="1")
+CLEANUP_EVERY = 200
+
+_cache = LRUCache(max_entries=INTERPRETATION_CACHE_MAX_ENTRIES, ttl=INTERPRETATION_CACHE_TTL)
+_stats_lock = threading.Lock()
+_stats = {'db_hits': 0, 'db_misses': 0, 'stores': 0}
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+        return _stats[name]
+
+def normalize_text(text):
+    return re.sub(r'\s+', ' ', text).strip()
+
+def cache_key(kind, text, language, specialists):
+    payload = json.dumps(
+        [INTERPRETATION_CACHE_VERSION, kind, normalize_text(text), language, sorted(specialists)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get(kind, text, language, specialists):
+    """Return the cached interpretation data for this text, or None."""
+    key = cache_key(kind, text, language, specialists)
+    data = _cache.get(key)
+    if data is None and INTERPRETATION_CACHE_PERSISTENT:
+        try:
+            data = get_cached_interpretation(key)
+        except Exception as e:
+            print(f"Interpretation cache read error: {e}")
+        if data is not None:
+            _count('db_hits')
+            _cache.set(key, data)
+        else:
+            _count('db_misses')
+    return data
+
+def store(kind, text, language, specialists, data):
+    key = cache_key(kind, text, language, specialists)
+    _cache.set(key, data)
+    stores = _count('stores')
+    if INTERPRETATION_CACHE_PERSISTENT:
+        try:
+            store_cached_interpretation(key, data, INTERPRETATION_CACHE_TTL)
+            if stores % CLEANUP_EVERY == 0:
+                delete_expired_interpretations()
+        except Exception as e:
+            print(f"Interpretation cache write error: {e}")
+
+def invalidate():
+    """Drop every cached interpretation, e.g. after a prompt or model change."""
+    _cache.clear()
+    if INTERPRETATION_CACHE_PERSISTENT:
+        clear_interpretation_cache()
+
+def stats():
+    with _stats_lock:
+        return {'memory': _cache.stats(), **_stats}
@@ -0,0 +1,94 @@
+from telebot.types import (
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+    KeyboardButton,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton
+)
+
+from translations import translations
+
+# Built once at import: keyboards are stored as the JSON telebot would send,
+# so handlers don't rebuild markups or look up button labels per message.
+
+languages = {
+    '🇬🇧 English': 'en',
+    '🇷🇺 Русский': 'ru',
+    '🇰🇿 Қазақша': 'kz'
+}
+
+def _reply_keyboard(rows, one_time_keyboard=True):
+    markup = ReplyKeyboardMarkup(one_time_keyboard=one_time_keyboard, resize_keyboard=True)
+    for row in rows:
+        markup.row(*[KeyboardButton(text=text) for text in row])
+    return markup.to_json()
+
+def _inline_keyboard(rows):
+    markup = InlineKeyboardMarkup()
+    for row in rows:
+        markup.row(*[InlineKeyboardButton(text, callback_data=callback_data) for text, callback_data in row])
+    return markup.to_json()
+
+# name -> function of a language's strings returning the keyboard JSON
+_layouts = {
+    'main_menu': lambda t: _reply_keyboard([[t['analyse'], t['payment']], [t['instruction'], t['info']]], one_time_keyboard=False),
+    'analyse': lambda t: _reply_keyboard([[t['analyse']]]),
+    'menu': lambda t: _reply_keyboard([[t['menu']]]),
+    'correct': lambda t: _reply_keyboard([[t['correct']]]),
+    'payment': lambda t: _reply_keyboard([[t['payment']]]),
+    'register': lambda t: _reply_keyboard([[t['register']], [t['menu']]]),
+    'empty': lambda t: _reply_keyboard([]),
+    'analyse_options': lambda t: _inline_keyboard([
+        [(t['Send_photo'], "analyse_1")],
+        [(t['Send_pdf_ios'], "analyse_2")],
+        [(t['Send_pdf_android'], "analyse_3")],
+        [(t['Send_screenshot'], "analyse_4")],
+    ]),
+    'products': lambda t: _inline_keyboard([
+        [(f"{t[product_id]['name']} - {t[product_id]['price']}", product_id)]
+        for product_id in ('product_500', 'product_1000')
+    ]),
+}
+
+_keyboards = {
+    (name, language): layout(strings)
+    for name, layout in _layouts.items()
+    for language, strings in translations.items()
+}
+
+LANGUAGE_MENU = _reply_keyboard([[name] for name in languages])
+LANGUAGE_CHOICE = _inline_keyboard([[(name, f"lang_{code}")] for name, code in languages.items()])
+REMOVE = ReplyKeyboardRemove().to_json()
+
+def keyboard(name, language):
+    return _keyboards[(name, language)]
+
+# (language, key) -> (template, needs_format); strings without braces, so without
+# placeholders or escaped {{ }}, skip str.format
+_templates = {
+    (language, key): (value, '{' in value or '}' in value)
+    for language, strings in translations.items()
+    for key, value in strings.items()
+    if isinstance(value, str)
+}
+
+def text(language, key, **kwargs):
+    template, needs_format = _templates.get((language, key), ("Translation missing!", False))
+    return template.format(**kwargs) if needs_format else template
+
+# Command and button text -> route name, one dict lookup per message
+ROUTES = {}
+for _route, _texts in {
+    'register': ["/register", "📝Register", "📝Регистрация", "📝Тіркелу"],
+    'language_change': list(languages),
+    'analyse': ["/analyse", "🔬 Analysis", "🔬 Анализировать", "🔬 Талдау"],
+    'info': [strings['info'] for strings in translations.values()],
+    'menu': ["/menu", "🔗Menu", "🔗Меню", "🔗Мәзір"],
+    'payment': ["/payment", "💰 Top up balance", "💰 Пополнить баланс", "💰 Баланс толтыру"],
+    'instruction': [strings['instruction'] for strings in translations.values()],
+}.items():
+    for _text in _texts:
+        ROUTES.setdefault(_text, _route)
+
+def route(message_text):
+    return ROUTES.get(message_text)
@@ -0,0 +1,225 @@
+import json
+import random
+import re
+import threading
+import time
+import openai
+import tiktoken
+from decouple import config
+
+LLM_MAX_ATTEMPTS = config("LLM_MAX_ATTEMPTS", default=3, cast=int)
+LLM_RETRY_BASE_DELAY = config("LLM_RETRY_BASE_DELAY", default=1.0, cast=float)
+LLM_RETRY_MAX_DELAY = config("LLM_RETRY_MAX_DELAY", default=20.0, cast=float)
+
+# OpenAI errors worth another attempt; anything else is reported to the user right away
+TRANSIENT_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+)
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    'attempts': 0,        # completions requested
+    'parsed': 0,          # completions that gave valid JSON straight away
+    'repaired': 0,        # completions that needed the repair pass
+    'wasted': 0,          # completions thrown away (no usable JSON or transient error)
+    'exhausted': 0,       # requests that gave up after max attempts
+}
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result['wasted_rate'] = result['wasted'] / result['attempts'] if result['attempts'] else 0.0
+    return result
+
+def backoff_delay(attempt, base_delay=LLM_RETRY_BASE_DELAY, max_delay=LLM_RETRY_MAX_DELAY):
+    """Exponential backoff with full jitter for the given 1-based attempt."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+def call_with_retry(fn, *args, max_attempts=3, retry_on=(Exception,), **kwargs):
+    """Call fn, retrying failures listed in retry_on with backoff; re-raises the last one."""
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return fn(*args, **kwargs)
+        except retry_on as e:
+            if attempt == max_attempts:
+                raise
+            delay = backoff_delay(attempt)
+            print(f"{getattr(fn, '__name__', 'call')} failed (attempt {attempt}/{max_attempts}): {e}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def repair_json(text):
+    """Try to salvage a slightly malformed JSON object from a model reply."""
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end <= start:
+        return None
+    candidate = text[start:end + 1]
+    # Trailing commas before a closing bracket
+    candidate = re.sub(r",\s*([}\]])", r"\1", candidate)
+    # Smart quotes used as JSON delimiters
+    candidate = candidate.replace('“', '"').replace('”', '"')
+    try:
+        # strict=False accepts raw newlines and tabs inside strings
+        return json.loads(candidate, strict=False)
+    except ValueError:
+        return None
+
+def parse_json_response(response_text):
+    """Return (data, repaired) for the JSON object in a model reply, data is None if there is none."""
+    json_match = re.search(r"```(?:json)?\s*(\{.*\})\s*```", response_text, re.DOTALL)
+    if json_match:
+        json_str = json_match.group(1).replace('\\\\\n', '\\\\n')
+        try:
+            return json.loads(json_str), False
+        except ValueError as e:
+            print("Error parsing JSON:", e)
+            print(repr(json_str))
+    else:
+        print("JSON extraction failed, full response:", response_text)
+    return repair_json(response_text), True
+
+def request_json(create_completion, required_keys=(), max_attempts=LLM_MAX_ATTEMPTS):
+    """Ask the model for a JSON object until one parses, at most max_attempts times.
+
+    create_completion() returns the reply text. Transient OpenAI errors and
+    unusable replies are retried with backoff; other errors propagate.
+    Returns the parsed dict, or None when every attempt failed.
+    """
+    for attempt in range(1, max_attempts + 1):
+        _count('attempts')
+        try:
+            response_text = create_completion()
+        except TRANSIENT_ERRORS as e:
+            print(f"Transient OpenAI error (attempt {attempt}/{max_attempts}): {e}")
+            response_text = None
+        if response_text is not None:
+            data, repaired = parse_json_response(response_text)
+            if isinstance(data, dict) and all(key in data for key in required_keys):
+                _count('repaired' if repaired else 'parsed')
+                return data
+        _count('wasted')
+        if attempt < max_attempts:
+            time.sleep(backoff_delay(attempt))
+    _count('exhausted')
+    return None
+
+def completion_text(response, on_text=None):
+    """Return the reply text of a ChatCompletion response.
+
+    A streamed response (stream=True) is read as it arrives and
+    on_text(text_so_far) is called after every received piece.
+    """
+    if isinstance(response, dict):
+        return response.choices[0].message['content'].strip()
+    parts = []
+    for chunk in response:
+        content = chunk.choices[0].delta.get('content') if chunk.choices else None
+        if content:
+            parts.append(content)
+            if on_text is not None:
+                on_text(''.join(parts))
+    return ''.join(parts).strip()
+
+def partial_json_string(text, key):
+    """Decode the (possibly unterminated) string value of key in a partial JSON reply."""
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), text)
+    if not match:
+        return None
+    value = []
+    i = match.end()
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            break
+        if char == '\\':
+            if i + 1 >= len(text):
+                break
+            escape = text[i + 1]
+            if escape == 'u':
+                if i + 6 > len(text):
+                    break
+                value.append(text[i:i + 6])
+                i += 6
+                continue
+            value.append(text[i:i + 2])
+            i += 2
+            continue
+        value.append(char)
+        i += 1
+    try:
+        return json.loads('"' + ''.join(value) + '"', strict=False)
+    except ValueError:
+        return None
+
+def get_encoding(model_name):
+    """Return the tiktoken encoding for model_name, loading it only once per process."""
+    encoding = _encodings.get(model_name)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(model_name)
+            if encoding is None:
+                try:
+                    encoding = tiktoken.encoding_for_model(model_name)
+                except KeyError:
+                    encoding = tiktoken.get_encoding("cl100k_base")
+                _encodings[model_name] = encoding
+    return encoding
+
+def tokenize_lines(text, model_name):
+    """Encode text once, line by line; returns [(line, tokens)] for counting and chunking."""
+    encoding = get_encoding(model_name)
+    # A plain loop: encode_ordinary_batch starts a thread pool per call, which costs more than it saves
+    return [(line, encoding.encode_ordinary(line)) for line in text.splitlines(keepends=True)]
+
+def count_tokens(tokenized_lines):
+    return sum(len(tokens) for _, tokens in tokenized_lines)
+
+def split_into_chunks(tokenized_lines, max_tokens, model_name):
+    """Group tokenized lines into chunks of at most max_tokens tokens.
+
+    Chunks end on a line break, preferably right after a blank line (page or
+    section break) in their second half, so lab tables are not cut mid-row. Only a single line
+    longer than max_tokens is split by token offsets.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    def flush(upto):
+        nonlocal current, current_tokens
+        chunks.append(''.join(line for line, _ in current[:upto]))
+        current = current[upto:]
+        current_tokens = sum(count for _, count in current)
+
+    for line, tokens in tokenized_lines:
+        count = len(tokens)
+        if count > max_tokens:
+            if current:
+                flush(len(current))
+            encoding = get_encoding(model_name)
+            for i in range(0, count, max_tokens):
+                chunks.append(encoding.decode(tokens[i:i + max_tokens]))
+            continue
+        while current and current_tokens + count > max_tokens:
+            # Cut after the last blank line, unless that would leave a chunk under half full
+            cut = len(current)
+            filled = 0
+            for i, (previous, previous_count) in enumerate(current):
+                filled += previous_count
+                if not previous.strip() and filled >= max_tokens // 2:
+                    cut = i + 1
+            flush(cut)
+        current.append((line, count))
+        current_tokens += count
+    if current:
+        flush(len(current))
+    return chunks
@@ -0,0 +1,59 @@
+import sys
+import threading
+from decouple import config
+
+from cache import LRUCache
+from database import claim_media_group, prune_media_groups
+
+# Albums arrive as separate updates within seconds; an id only needs remembering for a short while
+MEDIA_GROUP_TTL = config("MEDIA_GROUP_TTL", default=600, cast=int)
+MEDIA_GROUP_MAX_ENTRIES = config("MEDIA_GROUP_MAX_ENTRIES", default=10000, cast=int)
+MEDIA_GROUP_MAX_BYTES = config("MEDIA_GROUP_MAX_BYTES", default=2_000_000, cast=int)
+# Let every bot process agree on which album was already answered
+MEDIA_GROUP_SHARED = config("MEDIA_GROUP_SHARED", default=False, cast=bool)
+MEDIA_GROUP_PRUNE_EVERY = 500
+# OrderedDict node, dict slot and the (value, size, expires_at) tuple of one cache entry
+ENTRY_OVERHEAD = 200
+
+def _entry_size(media_group_id):
+    return sys.getsizeof(media_group_id) + ENTRY_OVERHEAD
+
+_seen = LRUCache(max_entries=MEDIA_GROUP_MAX_ENTRIES, max_size=MEDIA_GROUP_MAX_BYTES, sizeof=_entry_size, ttl=MEDIA_GROUP_TTL)
+_stats_lock = threading.Lock()
+_stats = {'first': 0, 'repeated': 0, 'db_claims': 0, 'db_errors': 0}
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+        return _stats[name]
+
+def first_seen(media_group_id):
+    """True for the first message of a media group, False for the rest of the album."""
+    if not _seen.add(media_group_id, media_group_id):
+        _count('repeated')
+        return False
+    if MEDIA_GROUP_SHARED:
+        try:
+            claimed = claim_media_group(media_group_id)
+            if _count('db_claims') % MEDIA_GROUP_PRUNE_EVERY == 0:
+                prune_media_groups(MEDIA_GROUP_TTL)
+        except Exception as e:
+            # Answering an album twice is better than not answering it
+            print(f"Media group claim error: {e}")
+            _count('db_errors')
+            claimed = True
+        if not claimed:
+            _count('repeated')
+            return False
+    _count('first')
+    return True
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    cache = _seen.stats()
+    result['entries'] = cache['entries']
+    result['memory_bytes'] = cache['size']
+    result['max_bytes'] = MEDIA_GROUP_MAX_BYTES
+    result['evictions'] = cache['evictions']
+    return result
@@ -0,0 +1,141 @@
+# Versioned schema migrations, applied in order by run_migrations().
+# Append new migrations at the end; never edit one that has been deployed.
+
+# Arbitrary key for pg_advisory_xact_lock, so only one process migrates at a time
+MIGRATIONS_LOCK_ID = 72310401
+
+MIGRATIONS = [
+    (1, "Initial schema", '''
+        CREATE TABLE IF NOT EXISTS user_points (
+            user_id BIGINT PRIMARY KEY,
+            points BIGINT,
+            name VARCHAR(255),
+            phone VARCHAR(225),
+            language VARCHAR(10),
+            first_time TIMESTAMP DEFAULT NULL,
+            last_time TIMESTAMP DEFAULT NULL,
+            user_state BIGINT DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS specialists (
+            id SERIAL PRIMARY KEY,          -- Unique ID for the specialization
+            name VARCHAR(255) NOT NULL,     -- Name of the specialization
+            rec_count INT DEFAULT 0         -- Recommendation counter
+        );
+
+        CREATE TABLE IF NOT EXISTS doctors (
+            id BIGSERIAL PRIMARY KEY, -- Unique identifier for each doctor
+            specialist_id INT REFERENCES specialists(id),
+            name VARCHAR(255),               -- Doctor's full name
+            position VARCHAR(255),           -- Doctor's job title
+            phone VARCHAR(20),        -- Doctor's contact number
+            medical_center VARCHAR(255) DEFAULT NULL,    -- The organization the doctor works for
+            address VARCHAR(255) DEFAULT NULL,           -- The address of the medical center
+            price INT DEFAULT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS invoices (
+            invoice_id BIGINT PRIMARY KEY,  -- Unique invoice ID
+            user_id BIGINT REFERENCES user_points(user_id) ON DELETE CASCADE,
+            product_id VARCHAR(255),
+            points BIGINT,
+            price INT,
+            processed BOOLEAN DEFAULT FALSE,
+            time TIMESTAMP DEFAULT NULL
+        );
+    '''),
+    (2, "Columns used by the code but missing from the initial schema", '''
+        ALTER TABLE user_points ADD COLUMN IF NOT EXISTS phone_number VARCHAR(32);
+        ALTER TABLE doctors ADD COLUMN IF NOT EXISTS link TEXT;
+    '''),
+    (3, "Indexes for specialist, doctor and invoice lookups", '''
+        CREATE INDEX IF NOT EXISTS specialists_name_idx ON specialists (name);
+        CREATE INDEX IF NOT EXISTS doctors_position_idx ON doctors (position);
+        CREATE INDEX IF NOT EXISTS invoices_user_id_idx ON invoices (user_id);
+    '''),
+    (4, "OCR and interpretation caches", '''
+        CREATE TABLE IF NOT EXISTS interpretation_cache (
+            cache_key CHAR(64) PRIMARY KEY,   -- SHA-256 of text, language, specialists and version
+            data JSONB NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS interpretation_cache_expires_at_idx ON interpretation_cache (expires_at);
+
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+            image_hash CHAR(64) PRIMARY KEY,  -- SHA-256 of the image bytes
+            text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS ocr_cache_created_at_idx ON ocr_cache (created_at);
+    '''),
+    (5, "Catalog change notifications", '''
+        -- Tell running bots to reload the specialists/doctors catalog
+        CREATE OR REPLACE FUNCTION notify_catalog_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS doctors_catalog_changed ON doctors;
+        CREATE TRIGGER doctors_catalog_changed
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON doctors
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_changed();
+
+        -- rec_count updates don't change the catalog
+        DROP TRIGGER IF EXISTS specialists_catalog_changed ON specialists;
+        CREATE TRIGGER specialists_catalog_changed
+            AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF name ON specialists
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_changed();
+    '''),
+    (6, "Persistent timers", '''
+        CREATE TABLE IF NOT EXISTS timers (
+            kind VARCHAR(64) NOT NULL,        -- Name of the registered callback
+            key BIGINT NOT NULL,              -- Callback argument, e.g. user_id
+            due_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (kind, key)
+        );
+    '''),
+    (7, "Media groups already answered, shared by bot processes", '''
+        CREATE TABLE IF NOT EXISTS media_groups (
+            media_group_id VARCHAR(64) PRIMARY KEY,
+            seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS media_groups_seen_at_idx ON media_groups (seen_at);
+    '''),
+]
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+def applied_version(c):
+    """Highest applied migration, 0 for a fresh database. Runs no DDL."""
+    c.execute("SELECT to_regclass('schema_migrations')")
+    if c.fetchone()[0] is None:
+        return 0
+    c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return c.fetchone()[0]
+
+def run_migrations(c):
+    """Apply pending migrations inside the cursor's transaction; returns the versions applied."""
+    if applied_version(c) >= latest_version():
+        return []
+    # Another process may be migrating right now; wait for it, then look again
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    current = applied_version(c)
+    applied = []
+    for version, description, sql in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"Applying migration {version}: {description}")
+        c.execute(sql)
+        c.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+        applied.append(version)
+    return applied
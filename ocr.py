@@ -0,0 +1,178 @@
+import hashlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+
+from cache import LRUCache
+from image_preprocess import prepare_image
+import image_preprocess
+from database import get_cached_ocr, store_cached_ocr, prune_ocr_cache
+
+GOOGLE_CLOUD_CREDENTIALS = config("GOOGLE_CLOUD_CREDENTIALS", default="")
+# cloud: Vision only; local: the local engine only; local_first: local engine, Vision when its
+# confidence is low; failover: Vision, the local engine when Vision fails or times out
+OCR_ROUTING = config("OCR_ROUTING", default="cloud")
+OCR_CLOUD_BACKEND = config("OCR_CLOUD_BACKEND", default="vision")
+OCR_LOCAL_BACKEND = config("OCR_LOCAL_BACKEND", default="tesseract")
+OCR_CLOUD_TIMEOUT = config("OCR_CLOUD_TIMEOUT", default=20.0, cast=float)
+OCR_LOCAL_MIN_CONFIDENCE = config("OCR_LOCAL_MIN_CONFIDENCE", default=75.0, cast=float)
+TESSERACT_LANGUAGES = config("TESSERACT_LANGUAGES", default="eng+rus+kaz")
+OCR_STUB_TEXT = config("OCR_STUB_TEXT", default="")
+OCR_CONCURRENCY = config("OCR_CONCURRENCY", default=8, cast=int)
+OCR_CACHE_MAX_ENTRIES = config("OCR_CACHE_MAX_ENTRIES", default=5000, cast=int)
+OCR_CACHE_MAX_CHARS = config("OCR_CACHE_MAX_CHARS", default=20_000_000, cast=int)
+OCR_CACHE_PERSISTENT = config("OCR_CACHE_PERSISTENT", default=False, cast=bool)
+OCR_CACHE_DB_MAX_ROWS = config("OCR_CACHE_DB_MAX_ROWS", default=100_000, cast=int)
+OCR_CACHE_PRUNE_EVERY = 500
+
+_backends = {}
+_client = None
+_client_lock = threading.Lock()
+# Shared by all analyses, so OCR_CONCURRENCY is also the process-wide limit of Vision calls
+_executor = ThreadPoolExecutor(max_workers=OCR_CONCURRENCY, thread_name_prefix="ocr")
+_cache = LRUCache(max_entries=OCR_CACHE_MAX_ENTRIES, max_size=OCR_CACHE_MAX_CHARS, sizeof=len)
+_stats_lock = threading.Lock()
+_stats = {'db_hits': 0, 'db_misses': 0, 'db_stores': 0, 'escalations': 0, 'failovers': 0, 'errors': 0}
+
+def image_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] = _stats.get(name, 0) + 1
+        return _stats[name]
+
+def register_backend(name):
+    """Register fn(image_bytes) -> (text, confidence) as an OCR backend.
+
+    confidence is 0-100, or None when the engine doesn't report one.
+    """
+    def decorator(fn):
+        _backends[name] = fn
+        return fn
+    return decorator
+
+def _vision_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from google.cloud import vision
+                _client = vision.ImageAnnotatorClient.from_service_account_json(GOOGLE_CLOUD_CREDENTIALS)
+    return _client
+
+@register_backend("vision")
+def _vision_ocr(image_bytes):
+    from google.cloud import vision
+    image_data = vision.Image(content=image_bytes)
+    response = _vision_client().text_detection(image=image_data, timeout=OCR_CLOUD_TIMEOUT)
+    if response.error.message:
+        raise RuntimeError(f"Vision error: {response.error.message}")
+    return (response.text_annotations[0].description.strip() if response.text_annotations else ''), None
+
+@register_backend("tesseract")
+def _tesseract_ocr(image_bytes):
+    import pytesseract
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        data = pytesseract.image_to_data(image, lang=TESSERACT_LANGUAGES, output_type=pytesseract.Output.DICT)
+    lines = {}
+    confidences = []
+    for word, conf, block, paragraph, line in zip(data['text'], data['conf'], data['block_num'], data['par_num'], data['line_num']):
+        if not word.strip():
+            continue
+        lines.setdefault((block, paragraph, line), []).append(word)
+        if float(conf) >= 0:
+            confidences.append(float(conf))
+    text = '\n'.join(' '.join(words) for words in lines.values())
+    return text, (sum(confidences) / len(confidences) if confidences else 0.0)
+
+# Offline runs and benchmarks, no network or OCR engine needed
+@register_backend("stub")
+def _stub_ocr(image_bytes):
+    return OCR_STUB_TEXT, None
+
+def run_backend(name, image_bytes):
+    _count(f'{name}_calls')
+    return _backends[name](image_bytes)
+
+def _single_backend_ocr(name, image_bytes):
+    # Nothing to fail over to: one unreadable image must not fail the whole document
+    try:
+        return run_backend(name, image_bytes)[0]
+    except Exception as e:
+        print(f"OCR {name} error, leaving the image out: {e}")
+        _count('errors')
+        return None
+
+def _routed_ocr(image_bytes):
+    """Text of the image, or None if OCR failed and there was no backend to fall back to."""
+    image_bytes = prepare_image(image_bytes)
+    if OCR_ROUTING == "local":
+        return _single_backend_ocr(OCR_LOCAL_BACKEND, image_bytes)
+    if OCR_ROUTING == "local_first":
+        text, confidence = run_backend(OCR_LOCAL_BACKEND, image_bytes)
+        if text and (confidence is None or confidence >= OCR_LOCAL_MIN_CONFIDENCE):
+            return text
+        _count('escalations')
+        try:
+            return run_backend(OCR_CLOUD_BACKEND, image_bytes)[0]
+        except Exception as e:
+            print(f"OCR {OCR_CLOUD_BACKEND} error, keeping {OCR_LOCAL_BACKEND} text: {e}")
+            return text
+    if OCR_ROUTING == "failover":
+        try:
+            return run_backend(OCR_CLOUD_BACKEND, image_bytes)[0]
+        except Exception as e:
+            print(f"OCR {OCR_CLOUD_BACKEND} error, failing over to {OCR_LOCAL_BACKEND}: {e}")
+            _count('failovers')
+            return run_backend(OCR_LOCAL_BACKEND, image_bytes)[0]
+    return _single_backend_ocr(OCR_CLOUD_BACKEND, image_bytes)
+
+def _cached_ocr(key, image_bytes):
+    text = _cache.get(key)
+    if text is not None:
+        return text
+    if OCR_CACHE_PERSISTENT:
+        try:
+            text = get_cached_ocr(key)
+        except Exception as e:
+            print(f"OCR cache read error: {e}")
+        if text is not None:
+            _count('db_hits')
+            _cache.set(key, text)
+            return text
+        _count('db_misses')
+    text = _routed_ocr(image_bytes)
+    if text is None:
+        # Not cached, the next document with this image tries again
+        return ''
+    _cache.set(key, text)
+    if OCR_CACHE_PERSISTENT:
+        try:
+            store_cached_ocr(key, text)
+            if _count('db_stores') % OCR_CACHE_PRUNE_EVERY == 0:
+                prune_ocr_cache(OCR_CACHE_DB_MAX_ROWS)
+        except Exception as e:
+            print(f"OCR cache write error: {e}")
+    return text
+
+def ocr_image(image_bytes):
+    return _cached_ocr(image_hash(image_bytes), image_bytes)
+
+def ocr_images(images):
+    """OCR a list of image bytes concurrently, results are in the same order.
+
+    Identical images (e.g. a logo repeated on every page) are OCRed once.
+    """
+    keys = [image_hash(image_bytes) for image_bytes in images]
+    unique = dict(zip(keys, images))
+    texts = dict(zip(unique, _executor.map(_cached_ocr, unique.keys(), unique.values())))
+    return [texts[key] for key in keys]
+
+def cache_stats():
+    with _stats_lock:
+        result = {'memory': _cache.stats(), **_stats}
+    result['preprocess'] = image_preprocess.stats()
+    return result
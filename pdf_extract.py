@@ -0,0 +1,121 @@
+import threading
+import fitz #Import PyMuPDF
+from decouple import config
+
+from ocr import ocr_images
+
+# Pages whose images are OCRed together; only their image bytes are held in memory at a time.
+# This trades latency for memory: OCR runs concurrently only within a window, so a document
+# takes the sum of each window's slowest image instead of its single slowest image.
+PDF_OCR_WINDOW = config("PDF_OCR_WINDOW", default=4, cast=int)
+# A page with this much extractable text already has its content; its images are logos, stamps or QR codes.
+# Images shown on more than PDF_TEXT_PAGE_MAX_AREA of such a page are still OCRed: a typed letterhead
+# above a scanned results table is common.
+PDF_TEXT_PAGE_CHARS = config("PDF_TEXT_PAGE_CHARS", default=400, cast=int)
+PDF_TEXT_PAGE_MAX_AREA = config("PDF_TEXT_PAGE_MAX_AREA", default=0.2, cast=float)
+# Images smaller than this (pixels per side) or shown on less than this share of the page hold no readable text
+PDF_OCR_MIN_SIDE = config("PDF_OCR_MIN_SIDE", default=64, cast=int)
+PDF_OCR_MIN_AREA = config("PDF_OCR_MIN_AREA", default=0.03, cast=float)
+# Lines, borders and dividers
+PDF_OCR_MAX_ASPECT = config("PDF_OCR_MAX_ASPECT", default=12.0, cast=float)
+# Turn off to OCR every embedded image, e.g. to benchmark extraction without the planner
+PDF_OCR_PLANNER = config("PDF_OCR_PLANNER", default=True, cast=bool)
+# Skips that depend only on the image, so they hold on every page it appears on
+IMAGE_SKIP_REASONS = ("too_small", "aspect_ratio")
+
+_stats_lock = threading.Lock()
+_stats = {'pages': 0, 'images': 0, 'sent': 0}
+
+def open_pdf(data):
+    """Open downloaded PDF bytes directly, without copying them into another buffer."""
+    return fitz.open(stream=data, filetype="pdf")
+
+def _count(reason):
+    with _stats_lock:
+        _stats[reason] = _stats.get(reason, 0) + 1
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+def _skip_reason(page, page_text, image, seen_xrefs):
+    xref, _, width, height = image[:4]
+    if xref in seen_xrefs:
+        return "duplicate"
+    if min(width, height) < PDF_OCR_MIN_SIDE:
+        return "too_small"
+    if max(width, height) > PDF_OCR_MAX_ASPECT * min(width, height):
+        return "aspect_ratio"
+    page_area = abs(page.rect)
+    if not page_area:
+        return None
+    shown_share = sum(abs(rect & page.rect) for rect in page.get_image_rects(xref)) / page_area
+    if shown_share < PDF_OCR_MIN_AREA:
+        return "small_on_page"
+    if shown_share < PDF_TEXT_PAGE_MAX_AREA and len(page_text.strip()) >= PDF_TEXT_PAGE_CHARS:
+        return "text_layer"
+    return None
+
+def plan_page_images(page, page_text, seen_xrefs):
+    """Return the xrefs of the page images that need OCR and log the decision for each image.
+
+    seen_xrefs holds the images already sent to OCR or skipped for reasons of their own
+    in this document and is updated. An image skipped because of its page is
+    considered again on the next page it appears on.
+    """
+    if not PDF_OCR_PLANNER:
+        return [image[0] for image in page.get_images(full=True)]
+    xrefs = []
+    for image in page.get_images(full=True):
+        xref = image[0]
+        reason = _skip_reason(page, page_text, image, seen_xrefs)
+        if reason is None or reason in IMAGE_SKIP_REASONS:
+            seen_xrefs.add(xref)
+        _count('images')
+        if reason is None:
+            _count('sent')
+            xrefs.append(xref)
+            print(f"Page {page.number + 1}, image {xref} ({image[2]}x{image[3]}): sent to OCR")
+        else:
+            _count(reason)
+            print(f"Page {page.number + 1}, image {xref} ({image[2]}x{image[3]}): skipped, {reason}")
+    return xrefs
+
+def _read_window(pdf_reader, start, stop, seen_xrefs):
+    page_texts = []
+    page_images = []
+    for page_num in range(start, stop):
+        page = pdf_reader[page_num]
+        page_text = page.get_text("text")
+        page_texts.append(page_text)
+        _count('pages')
+        for xref in plan_page_images(page, page_text, seen_xrefs):
+            page_images.append((page_num - start, pdf_reader.extract_image(xref)["image"]))
+    return page_texts, page_images
+
+def extract_pages(pdf_reader, window=PDF_OCR_WINDOW, ocr=ocr_images):
+    """Yield (page_text, image_texts) for every page, in order.
+
+    Only images picked by plan_page_images() are OCRed, those of `window`
+    pages at a time concurrently, and released before the next pages are read.
+    """
+    seen_xrefs = set()
+    for start in range(0, len(pdf_reader), window):
+        page_texts, page_images = _read_window(pdf_reader, start, min(start + window, len(pdf_reader)), seen_xrefs)
+        image_texts = [[] for _ in page_texts]
+        if page_images:
+            vision_texts = ocr([image_bytes for _, image_bytes in page_images])
+            for (page_index, _), vision_text in zip(page_images, vision_texts):
+                image_texts[page_index].append(vision_text)
+        del page_images
+        # MuPDF keeps decoded fonts and images of finished pages in its store;
+        # emptying it after every window is what actually bounds memory
+        fitz.TOOLS.store_shrink(100)
+        yield from zip(page_texts, image_texts)
+
+def extract_text(pdf_reader, window=PDF_OCR_WINDOW, ocr=ocr_images):
+    """Text of the whole document, each page followed by the text of its images."""
+    return "".join(
+        page_text + "\n" + "\n".join(image_texts) + "\n"
+        for page_text, image_texts in extract_pages(pdf_reader, window, ocr)
+    )
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import threading
+import time
+import httpx
+from decouple import config
+from telebot import apihelper
+
+# Telegram allows about 30 messages per second overall, one per second in a chat
+# (short bursts are tolerated) and 20 per minute in a group
+TELEGRAM_GLOBAL_RATE = config("TELEGRAM_GLOBAL_RATE", default=30.0, cast=float)
+TELEGRAM_CHAT_RATE = config("TELEGRAM_CHAT_RATE", default=1.0, cast=float)
+TELEGRAM_CHAT_BURST = config("TELEGRAM_CHAT_BURST", default=3, cast=int)
+TELEGRAM_GROUP_RATE = config("TELEGRAM_GROUP_RATE", default=20 / 60, cast=float)
+TELEGRAM_MAX_CONNECTIONS = config("TELEGRAM_MAX_CONNECTIONS", default=20, cast=int)
+TELEGRAM_MAX_RETRIES = config("TELEGRAM_MAX_RETRIES", default=3, cast=int)
+# A chat action is shown for 5 seconds; repeating it sooner changes nothing for the user
+TELEGRAM_CHAT_ACTION_INTERVAL = config("TELEGRAM_CHAT_ACTION_INTERVAL", default=4.0, cast=float)
+TELEGRAM_TIMEOUT = config("TELEGRAM_TIMEOUT", default=30.0, cast=float)
+MAX_CHAT_BUCKETS = 10000
+
+_loop = None
+_client = None
+_thread = None
+_start_lock = threading.Lock()
+_global_bucket = None
+_chat_buckets = {}
+_chat_actions = {}  # (chat_id, action) -> monotonic time it was last sent
+_chat_actions_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'coalesced_actions': 0, 'throttled': 0, 'throttle_seconds': 0.0}
+
+class Response:
+    """What telebot reads from a response: status_code, reason, text and json()."""
+
+    def __init__(self, status_code, text, reason='', content=None):
+        self.status_code = status_code
+        self.text = text
+        self.reason = reason
+        self.content = content if content is not None else text.encode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+_OK = Response(200, '{"ok": true, "result": true}', 'OK')
+
+class _Bucket:
+    """Token bucket; tokens may go negative, which queues callers behind each other."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self):
+        """Take a token and return how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+def _chat_bucket(chat_id):
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(_chat_buckets) >= MAX_CHAT_BUCKETS:
+            # Chats idle long enough to be full again carry no state worth keeping
+            cutoff = time.monotonic() - 60
+            for key in [key for key, value in _chat_buckets.items() if value.updated < cutoff and value.blocked_until < time.monotonic()]:
+                del _chat_buckets[key]
+        group = chat_id.startswith('-')
+        bucket = _Bucket(TELEGRAM_GROUP_RATE, 1) if group else _Bucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        _chat_buckets[chat_id] = bucket
+    return bucket
+
+async def _throttle(chat_id, per_chat):
+    # Runs on the loop thread only, so the buckets need no lock
+    wait = _global_bucket.reserve()
+    if chat_id is not None and per_chat:
+        wait = max(wait, _chat_bucket(chat_id).reserve())
+    if wait > 0:
+        _count('throttled')
+        _count('throttle_seconds', wait)
+        await asyncio.sleep(wait)
+
+def _timeout(timeout):
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout or TELEGRAM_TIMEOUT)
+
+async def _request(method, url, params, files, timeout, per_chat=True):
+    chat_id = str(params['chat_id']) if params and params.get('chat_id') is not None else None
+    for attempt in range(1, TELEGRAM_MAX_RETRIES + 1):
+        await _throttle(chat_id, per_chat)
+        _count('requests')
+        response = await _client.request(method.upper(), url, params=params, files=files, timeout=_timeout(timeout))
+        if response.status_code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+            break
+        _count('rate_limited')
+        try:
+            retry_after = response.json()['parameters']['retry_after']
+        except (ValueError, KeyError, TypeError):
+            retry_after = 1
+        print(f"Telegram rate limit on {url.rsplit('/', 1)[-1]}, retrying in {retry_after}s")
+        # Hold back everything else for this chat (or everything, without a chat) as well
+        (_chat_bucket(chat_id) if chat_id is not None else _global_bucket).block(retry_after)
+        _count('retries')
+    return Response(response.status_code, response.text, response.reason_phrase, response.content)
+
+async def _send_quietly(method, url, params, timeout):
+    try:
+        # Chat actions don't count against the per-chat message limit
+        response = await _request(method, url, params, None, timeout, per_chat=False)
+        if response.status_code != 200:
+            print(f"Telegram chat action failed: {response.status_code} {response.text}")
+    except Exception as e:
+        print(f"Telegram chat action failed: {e}")
+
+def _coalesce_chat_action(params):
+    """True if the same action was sent to the chat recently enough to skip this one."""
+    key = (str(params.get('chat_id')), params.get('action'))
+    now = time.monotonic()
+    with _chat_actions_lock:
+        if now - _chat_actions.get(key, float('-inf')) < TELEGRAM_CHAT_ACTION_INTERVAL:
+            return True
+        if len(_chat_actions) >= MAX_CHAT_BUCKETS:
+            for old_key in [old_key for old_key, sent in _chat_actions.items() if now - sent >= TELEGRAM_CHAT_ACTION_INTERVAL]:
+                del _chat_actions[old_key]
+        _chat_actions[key] = now
+    return False
+
+def send_request(method, url, params=None, files=None, timeout=None, proxies=None):
+    """telebot CUSTOM_REQUEST_SENDER: run the request on the shared async client.
+
+    Chat actions are not waited for, and repeats within
+    TELEGRAM_CHAT_ACTION_INTERVAL are dropped.
+    """
+    loop = start()
+    if url.endswith('/sendChatAction') and params and not files:
+        if _coalesce_chat_action(params):
+            _count('coalesced_actions')
+        else:
+            asyncio.run_coroutine_threadsafe(_send_quietly(method, url, dict(params), timeout), loop)
+        return _OK
+    return asyncio.run_coroutine_threadsafe(_request(method, url, params, files, timeout), loop).result()
+
+def download_file(token, file_path):
+    """Like TeleBot.download_file, over the pooled connections."""
+    if apihelper.FILE_URL is None:
+        url = "https://api.telegram.org/file/bot{0}/{1}".format(token, file_path)
+    else:
+        url = apihelper.FILE_URL.format(token, file_path)
+
+    async def fetch():
+        return await _client.get(url, timeout=_timeout(None))
+    response = asyncio.run_coroutine_threadsafe(fetch(), start()).result()
+    if response.status_code != 200:
+        raise apihelper.ApiHTTPException('Download file', Response(response.status_code, response.text, response.reason_phrase))
+    return response.content
+
+def _run_loop(loop, ready):
+    global _client, _global_bucket
+    asyncio.set_event_loop(loop)
+    proxy = apihelper.proxy.get('https') if apihelper.proxy else None
+    _client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=TELEGRAM_MAX_CONNECTIONS, max_keepalive_connections=TELEGRAM_MAX_CONNECTIONS),
+        timeout=TELEGRAM_TIMEOUT,
+        proxy=proxy
+    )
+    _global_bucket = _Bucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+    ready.set()
+    loop.run_forever()
+
+def start():
+    """Start the client's event loop thread if needed and return the loop."""
+    global _loop, _thread
+    if _loop is None:
+        with _start_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                _thread = threading.Thread(target=_run_loop, args=(loop, ready), name="telegram-client", daemon=True)
+                _thread.start()
+                ready.wait()
+                _loop = loop
+    return _loop
+
+def install():
+    """Send every telebot API request through this client."""
+    start()
+    apihelper.CUSTOM_REQUEST_SENDER = send_request
+
+def installed():
+    return apihelper.CUSTOM_REQUEST_SENDER is send_request
+
+def stop():
+    global _loop, _thread
+    with _start_lock:
+        loop = _loop
+        if loop is None:
+            return
+        if apihelper.CUSTOM_REQUEST_SENDER is send_request:
+            apihelper.CUSTOM_REQUEST_SENDER = None
+        asyncio.run_coroutine_threadsafe(_client.aclose(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        _thread.join(timeout=5)
+        _loop = None
+        _thread = None
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result['throttle_seconds'] = round(result['throttle_seconds'], 1)
+    result['chats'] = len(_chat_buckets)
+    return result
@@ -0,0 +1,118 @@
+import heapq
+import itertools
+import threading
+from datetime import datetime, timedelta, timezone
+from decouple import config
+
+import update_queue
+from database import save_timer, delete_timer, claim_timer, load_timers
+
+# Delay before retrying a timer whose callback could not be queued
+TIMER_RETRY_DELAY = config("TIMER_RETRY_DELAY", default=5, cast=int)
+
+_callbacks = {}
+_lock = threading.Condition()
+_heap = []  # (due_at, seq, kind, key); entries superseded in _deadlines are skipped when popped
+_deadlines = {}  # (kind, key) -> (due_at, seq)
+_seq = itertools.count()
+_thread = None
+_stopping = False
+_stats = {'scheduled': 0, 'cancelled': 0, 'fired': 0, 'skipped': 0}
+
+def register(fn, kind=None):
+    """Register fn(key) as the callback of timers of this kind (the function name by default)."""
+    _callbacks[kind or fn.__name__] = fn
+    return fn
+
+def _now():
+    return datetime.now(timezone.utc)
+
+def _push(kind, key, due_at):
+    seq = next(_seq)
+    _deadlines[(kind, key)] = (due_at, seq)
+    heapq.heappush(_heap, (due_at, seq, kind, key))
+    # Drop superseded entries once they make up most of the heap
+    if len(_heap) > 2 * len(_deadlines) + 64:
+        _heap[:] = [entry for entry in _heap if _deadlines.get((entry[2], entry[3]), (None, None))[1] == entry[1]]
+        heapq.heapify(_heap)
+    _lock.notify()
+
+def schedule(kind, key, delay_seconds):
+    """Run the callback of kind with key after delay_seconds, replacing a pending timer for the same key."""
+    due_at = _now() + timedelta(seconds=delay_seconds)
+    save_timer(kind, key, due_at)
+    with _lock:
+        _push(kind, key, due_at)
+        _stats['scheduled'] += 1
+
+def cancel(kind, key):
+    """Cancel a pending timer, including one loaded by or scheduled in another process."""
+    with _lock:
+        if _deadlines.pop((kind, key), None) is not None:
+            _stats['cancelled'] += 1
+    delete_timer(kind, key)
+
+def _fire(kind, key, due_at):
+    callback = _callbacks.get(kind)
+    if callback is None:
+        print(f"No callback registered for timer {kind}, leaving it for another process")
+        return
+    try:
+        if not claim_timer(kind, key, due_at):
+            with _lock:
+                _stats['skipped'] += 1
+            return
+        if update_queue.submit(key, callback, key):
+            with _lock:
+                _stats['fired'] += 1
+            return
+        # The update queue is full; try again shortly
+        schedule(kind, key, TIMER_RETRY_DELAY)
+    except Exception as e:
+        print(f"Error firing timer {kind} for {key}: {e}")
+
+def _run():
+    while True:
+        with _lock:
+            while not _stopping:
+                if _heap:
+                    due_at, seq, kind, key = _heap[0]
+                    if _deadlines.get((kind, key), (None, None))[1] != seq:
+                        heapq.heappop(_heap)
+                        continue
+                    wait = (due_at - _now()).total_seconds()
+                    if wait <= 0:
+                        heapq.heappop(_heap)
+                        del _deadlines[(kind, key)]
+                        break
+                    _lock.wait(wait)
+                else:
+                    _lock.wait()
+            if _stopping:
+                return
+        _fire(kind, key, due_at)
+
+def start():
+    """Load persisted timers, overdue ones fire right away, and start the scheduler thread.
+
+    Call after registering every callback: a timer without one is left to another process.
+    """
+    global _thread
+    with _lock:
+        if _thread is not None:
+            return
+        for kind, key, due_at in load_timers():
+            if (kind, key) not in _deadlines:
+                _push(kind, key, due_at)
+        _thread = threading.Thread(target=_run, name="timers", daemon=True)
+        _thread.start()
+
+def stop():
+    global _stopping
+    with _lock:
+        _stopping = True
+        _lock.notify()
+
+def stats():
+    with _lock:
+        return {'pending': len(_deadlines), 'heap': len(_heap), **_stats}
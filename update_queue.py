@@ -0,0 +1,89 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+
+UPDATE_WORKERS = config("UPDATE_WORKERS", default=8, cast=int)
+UPDATE_QUEUE_SIZE = config("UPDATE_QUEUE_SIZE", default=200, cast=int)
+
+_executor = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="update-worker")
+_lock = threading.Lock()
+# chat_id -> deque of pending jobs; a chat is present while it has work queued or running
+_chat_queues = {}
+_pending = 0
+_active = 0
+_closing = False
+_stats = {
+    'accepted': 0,
+    'rejected': 0,
+    'processed': 0,
+    'failed': 0,
+    'max_pending': 0,
+}
+
+def submit(chat_id, fn, *args):
+    """Queue fn(*args) behind earlier jobs of the same chat.
+
+    Jobs of one chat run one at a time and in order, different chats run
+    concurrently. Returns False without queueing when the queue is full.
+    """
+    global _pending
+    with _lock:
+        if _closing or _pending >= UPDATE_QUEUE_SIZE:
+            _stats['rejected'] += 1
+            return False
+        _pending += 1
+        _stats['accepted'] += 1
+        _stats['max_pending'] = max(_stats['max_pending'], _pending)
+        queue = _chat_queues.get(chat_id)
+        if queue is None:
+            _chat_queues[chat_id] = deque([(fn, args)])
+            _executor.submit(_run_next, chat_id)
+        else:
+            queue.append((fn, args))
+    return True
+
+def _run_next(chat_id):
+    global _pending, _active
+    while True:
+        with _lock:
+            fn, args = _chat_queues[chat_id][0]
+            _active += 1
+        try:
+            fn(*args)
+            failed = False
+        except Exception as e:
+            print(f"Error processing update for chat {chat_id}: {e}")
+            failed = True
+        with _lock:
+            _active -= 1
+            _pending -= 1
+            _stats['failed' if failed else 'processed'] += 1
+            queue = _chat_queues[chat_id]
+            queue.popleft()
+            if not queue:
+                del _chat_queues[chat_id]
+                return
+            if not _closing:
+                # Go to the back of the executor queue so one busy chat can't starve the others
+                _executor.submit(_run_next, chat_id)
+                return
+
+def stats():
+    with _lock:
+        return {
+            'pending': _pending,
+            'active': _active,
+            'queued': _pending - _active,
+            'chats': len(_chat_queues),
+            'workers': UPDATE_WORKERS,
+            'capacity': UPDATE_QUEUE_SIZE,
+            **_stats,
+        }
+
+def shutdown(wait=True):
+    """Stop accepting updates and let the workers finish what is queued."""
+    global _closing
+    with _lock:
+        _closing = True
+    _executor.shutdown(wait=wait)